@@ -0,0 +1,295 @@
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+
+from pathlib import Path, PurePath
+from string import punctuation
+
+import config
+import utils
+import prepare_data
+import postprocess_data
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+SEGMENT_LEN = 8  # tokens per synthetic caption line
+
+
+def max_rss_mb():
+    # Peak resident memory of this process so far (KB on Linux, bytes on macOS)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def timed(func, n_videos, n_tokens):
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    return result, {
+        "seconds": seconds,
+        "videos_per_s": n_videos / seconds if seconds else None,
+        "tokens_per_s": n_tokens / seconds if seconds else None,
+        "max_rss_mb": max_rss_mb(),
+    }
+
+
+def load_bundled_raw_transcripts(data_path):
+    raw_path = PurePath(data_path, "transcripts", config.LANGUAGE, "raw_transcripts")
+    names = sorted(f.stem for f in Path(raw_path).glob("*.json"))
+    return pd.concat([utils.read_df(raw_path, name, "json") for name in names])
+
+
+def check_opcodes_backend(data_path):
+    # Number of bundled videos whose "opcodes" diffs differ from the "differ"
+    # ones or from the saved labeled transcripts, which it must reproduce
+    labeled_path = PurePath(
+        data_path, "transcripts", config.LANGUAGE, "labeled_transcripts"
+    )
+    n_videos = n_mismatches = 0
+    for name in sorted(f.stem for f in Path(labeled_path).glob("*.json")):
+        labeled_df = utils.read_df(labeled_path, name, "json")
+        for video_id, t in labeled_df.iterrows():
+            diffs = prepare_data.generate_diff(t, "opcodes")
+            if diffs != prepare_data.generate_diff(t, "differ"):
+                print(f"{name} {video_id}: opcodes and differ diffs differ")
+                n_mismatches += 1
+            elif diffs != t["diffs"]:
+                print(f"{name} {video_id}: opcodes and saved diffs differ")
+                n_mismatches += 1
+            n_videos += 1
+    print(f"checked {n_videos} videos, {n_mismatches} mismatches")
+    return n_mismatches
+
+
+def to_segments(tokens):
+    return [
+        {
+            "text": " ".join(tokens[i : i + SEGMENT_LEN]),
+            "start": i / SEGMENT_LEN * 2.0,
+            "duration": 2.5,
+        }
+        for i in range(0, len(tokens), SEGMENT_LEN)
+    ]
+
+
+def synthetic_raw_transcripts(n_tokens, vocabulary, seed=0):
+    # One video of `n_tokens` manual tokens, with an autogen version carrying
+    # case, punctuation, substitution, deletion and insertion errors
+    rng = random.Random(seed)
+    manual = [rng.choice(vocabulary) for _ in range(n_tokens)]
+    autogen = []
+    for token in manual:
+        r = rng.random()
+        if r < 0.03:
+            autogen.append(token.lower())
+        elif r < 0.06:
+            autogen.append(token.strip(punctuation) or token)
+        elif r < 0.08:
+            autogen.append(rng.choice(vocabulary))
+        elif r < 0.09:
+            continue
+        elif r < 0.10:
+            autogen.extend([token, rng.choice(vocabulary)])
+        else:
+            autogen.append(token)
+
+    video_id = f"synthetic_{n_tokens}"
+    return pd.DataFrame(
+        {
+            "video_titles": [video_id],
+            "playlist_ids": [""],
+            "channel_ids": [""],
+            "autogen": [to_segments(autogen)],
+            "manual": [to_segments(manual)],
+        },
+        index=[video_id],
+    )
+
+
+def benchmark_transcripts(raw_transcripts_df, diff_backend):
+    # Times each stage from raw transcripts to split files, on `raw_transcripts_df`
+    results = {}
+    n_videos = len(raw_transcripts_df)
+
+    def extract_texts():
+        return [
+            {
+                "autogen_text": prepare_data.extract_text(autogen),
+                "manual_text": prepare_data.extract_text(manual),
+            }
+            for autogen, manual in zip(
+                raw_transcripts_df["autogen"], raw_transcripts_df["manual"]
+            )
+        ]
+
+    texts, results["extract_text"] = timed(extract_texts, n_videos, 0)
+
+    # throughput is reported per autogen token for every stage
+    n_tokens = sum(len(t["autogen_text"].split()) for t in texts)
+    results["extract_text"]["tokens_per_s"] = (
+        n_tokens / results["extract_text"]["seconds"]
+    )
+
+    diffs, results["generate_diff"] = timed(
+        lambda: [prepare_data.generate_diff(t, diff_backend) for t in texts],
+        n_videos,
+        n_tokens,
+    )
+
+    labels, results["label_diff_targets"] = timed(
+        lambda: [prepare_data.label_diff_targets({"diffs": d}) for d in diffs],
+        n_videos,
+        n_tokens,
+    )
+
+    labeled_df = raw_transcripts_df.copy()
+    for column in prepare_data.LABEL_COLUMNS:
+        labeled_df[column] = [label[column] for label in labels]
+
+    # fresh caches, so that stages don't get faster with the order they run in
+    import nltk
+    from nltk.stem.porter import PorterStemmer
+
+    token_caches = postprocess_data.make_token_caches(
+        nltk.RegexpTokenizer(r"\w+"), PorterStemmer()
+    )
+    postproc_df, results["add_diff_type_labels"] = timed(
+        lambda: postprocess_data.add_diff_type_labels(labeled_df, token_caches),
+        n_videos,
+        n_tokens,
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        postproc_path = Path(tmp_path, "postproc")
+        postproc_path.mkdir()
+        utils.write_df(
+            postproc_df[["diff_type", "default_seq", "correction_seq"]]
+            .reset_index()
+            .rename(columns={"index": "video_ids"}),
+            postproc_path,
+            "benchmark",
+            orient="records",
+        )
+        _, results["split_files_by_lines"] = timed(
+            lambda: utils.split_files_by_lines(
+                postproc_path,
+                Path(tmp_path, "split"),
+                "benchmark",
+                config.SPLIT_FILE_N_LINES,
+            ),
+            n_videos,
+            n_tokens,
+        )
+
+    for stage_results in results.values():
+        stage_results["videos"] = n_videos
+        stage_results["tokens"] = n_tokens
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_PATH,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    for dataset, stages in results["datasets"].items():
+        print(f"\n{dataset}")
+        for stage, r in stages.items():
+            line = (
+                f"  {stage:<22} {r['seconds']:8.3f}s  "
+                f"{r['videos_per_s'] or 0:9.1f} videos/s  "
+                f"{r['tokens_per_s'] or 0:11.0f} tokens/s  "
+                f"max rss {r['max_rss_mb']:7.1f}MB"
+            )
+            try:
+                baseline_seconds = baseline["datasets"][dataset][stage]["seconds"]
+                line += f"  {r['seconds'] / baseline_seconds:5.2f}x baseline time"
+            except (TypeError, KeyError, ZeroDivisionError):
+                pass
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--data_path",
+        default=str(REPO_PATH / "data"),
+        help="dataset with transcripts/<lang>/raw_transcripts",
+    )
+    parser.add_argument(
+        "--scales",
+        nargs="*",
+        type=int,
+        default=[10_000, 50_000],
+        help="token counts of synthetic transcripts, e.g. 10000 200000",
+    )
+    parser.add_argument(
+        "--no_bundled", action="store_true", help="skip the bundled transcripts"
+    )
+    parser.add_argument(
+        "--diff_backend",
+        choices=prepare_data.DIFF_BACKENDS,
+        default=config.DIFF_BACKEND,
+    )
+    parser.add_argument("-o", "--output", default=None, help="save results as json")
+    parser.add_argument(
+        "--compare", default=None, help="results json of an earlier run to compare"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only check the opcodes backend against differ and the saved diffs",
+    )
+
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(1 if check_opcodes_backend(args.data_path) else 0)
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "diff_backend": args.diff_backend,
+        "datasets": {},
+    }
+
+    bundled_df = load_bundled_raw_transcripts(args.data_path)
+    if not args.no_bundled:
+        results["datasets"]["bundled"] = benchmark_transcripts(
+            bundled_df, args.diff_backend
+        )
+
+    vocabulary = " ".join(
+        bundled_df["manual"].map(prepare_data.extract_text).tolist()
+    ).split()
+    for n_tokens in args.scales:
+        results["datasets"][f"synthetic_{n_tokens}"] = benchmark_transcripts(
+            synthetic_raw_transcripts(n_tokens, vocabulary), args.diff_backend
+        )
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,55 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from pathlib import Path
+
+MODULES = ["config", "utils", "request_data", "prepare_data", "postprocess_data"]
+
+IMPORT_TIMER = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def time_import(module, n_runs):
+    # Each import runs in a fresh interpreter, so nothing is already loaded
+    src_path = Path(__file__).resolve().parent
+    seconds = []
+    for _ in range(n_runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_TIMER.format(module=module)],
+            cwd=src_path,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        seconds.append(float(output.split()[-1]))
+    return {"min_s": min(seconds), "median_s": statistics.median(seconds)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-n", "--n_runs", type=int, default=5)
+    parser.add_argument(
+        "-o", "--output", default=None, help="also save results to this json file"
+    )
+
+    args = parser.parse_args()
+
+    results = {}
+    for module in MODULES:
+        results[module] = time_import(module, args.n_runs)
+        print(
+            f"{module:<18} min {results[module]['min_s']:.3f}s  "
+            f"median {results[module]['median_s']:.3f}s"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
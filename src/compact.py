@@ -0,0 +1,292 @@
+import json
+import numpy as np
+import pandas as pd
+
+from pathlib import Path, PurePath
+
+import config
+import utils
+from prepare_data import AUTOGEN_UNIQUE, MANUAL_UNIQUE, LABEL_COLUMNS
+
+# Token sequences of labeled and postproc transcripts as int32 ids into one
+# corpus-wide vocabulary, with id 0 for "". Labels are int8.
+#
+# Labeled transcripts: `diffs` and `manual_addl_rep` follow from the label
+# sequences (dicts of `diffs` are always separated by a common token), and the
+# joined `manual_seq` string repeated over a BOTH_DIFFER run is kept once, as
+# `manual_ids[manual_offsets[g] : manual_offsets[g + 1]]` with `manual_groups`
+# giving the group `g` of each position (-1 for "").
+
+COMPACT_LABEL_COLUMNS = [
+    "is_autogen_unique",
+    "is_manual_unique",
+    "common_to_both_ids",
+    "autogen_ids",
+    "manual_groups",
+    "manual_ids",
+    "manual_offsets",
+]
+COMPACT_POSTPROC_COLUMNS = ["diff_type", "default_ids", "correction_ids"]
+# as `write_df` is called on each in prepare_data and postprocess_data
+ORIENTS = {"labeled_transcripts": None, "postproc_transcripts": "records"}
+COMPACT_DTYPES = {
+    "is_autogen_unique": np.int8,
+    "is_manual_unique": np.int8,
+    "diff_type": np.int8,
+    "manual_groups": np.int32,
+    "manual_offsets": np.int32,
+}
+
+
+def build_vocabulary(labeled_dfs=(), postproc_dfs=()):
+    tokens = set()
+    for df in labeled_dfs:
+        for column in ["common_to_both_seq", "autogen_seq"]:
+            for seq in df[column]:
+                tokens.update(seq)
+        for seq in df["manual_seq"]:
+            for joined in set(seq):
+                tokens.update(joined.split())
+    for df in postproc_dfs:
+        for column in ["default_seq", "correction_seq"]:
+            for seq in df[column]:
+                tokens.update(seq)
+    tokens.discard("")
+    return [""] + sorted(tokens)
+
+
+def save_vocabulary(vocabulary, file_path):
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(file_path, "w") as f:
+        json.dump(vocabulary, f)
+
+
+def load_vocabulary(file_path):
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def to_ids(tokens, token_ids):
+    return np.array([token_ids[token] for token in tokens], dtype=np.int32)
+
+
+def to_tokens(ids, vocabulary):
+    return [vocabulary[i] for i in ids]
+
+
+def label_runs(labels):
+    # (label, start, end) of each run of the same label, where every
+    # MANUAL_INSERT is a run of its own, as it comes from a diff of its own
+    start = 0
+    for i in range(1, len(labels) + 1):
+        if (
+            i == len(labels)
+            or labels[i] != labels[start]
+            or labels[i] == config.MANUAL_INSERT
+        ):
+            yield labels[start], start, i
+            start = i
+
+
+def decode_diffs(t):
+    # `diffs` and `manual_addl_rep` of a labeled transcript `t`, from its labels
+    diffs = []
+    manual_addl_rep = []
+    for label, start, end in label_runs(t["is_autogen_unique"]):
+        if label == config.BOTH_AGREE:
+            diffs.extend(t["common_to_both_seq"][start:end])
+            manual_addl_rep.extend([0] * (end - start))
+        elif label == config.MANUAL_INSERT:
+            diffs.append(
+                {AUTOGEN_UNIQUE: [], MANUAL_UNIQUE: t["manual_seq"][start].split()}
+            )
+            manual_addl_rep.append(0)
+        elif label == config.AUTOGEN_INSERT:
+            diffs.append(
+                {AUTOGEN_UNIQUE: list(t["autogen_seq"][start:end]), MANUAL_UNIQUE: []}
+            )
+            manual_addl_rep.extend([0] * (end - start))
+        else:
+            diffs.append(
+                {
+                    AUTOGEN_UNIQUE: list(t["autogen_seq"][start:end]),
+                    MANUAL_UNIQUE: t["manual_seq"][start].split(),
+                }
+            )
+            manual_addl_rep.extend([end - start - 1] * (end - start))
+    return diffs, manual_addl_rep
+
+
+def encode_labels(t, token_ids):
+    # Compact columns of one labeled transcript `t` (a row or dict)
+    decoded_diffs, decoded_addl_rep = decode_diffs(t)
+    if decoded_diffs != list(t["diffs"]) or decoded_addl_rep != list(
+        t["manual_addl_rep"]
+    ):
+        raise ValueError("diffs don't match the label sequences")
+
+    manual_groups = []
+    manual_ids = []
+    manual_offsets = [0]
+    for label, start, end in label_runs(t["is_autogen_unique"]):
+        if label in (config.BOTH_DIFFER, config.MANUAL_INSERT):
+            manual_groups.extend([len(manual_offsets) - 1] * (end - start))
+            manual_ids.extend(
+                token_ids[token] for token in t["manual_seq"][start].split()
+            )
+            manual_offsets.append(len(manual_ids))
+        else:
+            manual_groups.extend([-1] * (end - start))
+
+    return {
+        "is_autogen_unique": np.array(t["is_autogen_unique"], dtype=np.int8),
+        "is_manual_unique": np.array(t["is_manual_unique"], dtype=np.int8),
+        "common_to_both_ids": to_ids(t["common_to_both_seq"], token_ids),
+        "autogen_ids": to_ids(t["autogen_seq"], token_ids),
+        "manual_groups": np.array(manual_groups, dtype=np.int32),
+        "manual_ids": np.array(manual_ids, dtype=np.int32),
+        "manual_offsets": np.array(manual_offsets, dtype=np.int32),
+    }
+
+
+def decode_labels(t, vocabulary):
+    manual_seq = []
+    for group in t["manual_groups"]:
+        if group < 0:
+            manual_seq.append("")
+        else:
+            ids = t["manual_ids"][
+                t["manual_offsets"][group] : t["manual_offsets"][group + 1]
+            ]
+            manual_seq.append(" ".join(to_tokens(ids, vocabulary)))
+
+    labels = {
+        "common_to_both_seq": to_tokens(t["common_to_both_ids"], vocabulary),
+        "is_autogen_unique": [int(label) for label in t["is_autogen_unique"]],
+        "is_manual_unique": [int(label) for label in t["is_manual_unique"]],
+        "autogen_seq": to_tokens(t["autogen_ids"], vocabulary),
+        "manual_seq": manual_seq,
+    }
+    labels["diffs"], labels["manual_addl_rep"] = decode_diffs(labels)
+    return labels
+
+
+def replace_columns(df, old_columns, new_columns):
+    # `df` with `old_columns` swapped for `new_columns` (a dict of lists) where
+    # the first of them was, keeping the order of the other columns
+    first = min(df.columns.get_loc(column) for column in old_columns)
+    kept = df.drop(columns=old_columns)
+    new_df = pd.DataFrame(new_columns, index=df.index)
+    return pd.concat([kept.iloc[:, :first], new_df, kept.iloc[:, first:]], axis=1)
+
+
+def encode_labeled(df, token_ids):
+    encoded = [
+        encode_labels(t, token_ids) for t in df[LABEL_COLUMNS].to_dict("records")
+    ]
+    return replace_columns(
+        df,
+        LABEL_COLUMNS,
+        {column: [e[column] for e in encoded] for column in COMPACT_LABEL_COLUMNS},
+    )
+
+
+def decode_labeled(df, vocabulary):
+    decoded = [
+        decode_labels(t, vocabulary)
+        for t in df[COMPACT_LABEL_COLUMNS].to_dict("records")
+    ]
+    return replace_columns(
+        df,
+        COMPACT_LABEL_COLUMNS,
+        {column: [d[column] for d in decoded] for column in LABEL_COLUMNS},
+    )
+
+
+def encode_postproc(df, token_ids):
+    return replace_columns(
+        df,
+        ["diff_type", "default_seq", "correction_seq"],
+        {
+            "diff_type": [np.array(seq, dtype=np.int8) for seq in df["diff_type"]],
+            "default_ids": [to_ids(seq, token_ids) for seq in df["default_seq"]],
+            "correction_ids": [to_ids(seq, token_ids) for seq in df["correction_seq"]],
+        },
+    )
+
+
+def decode_postproc(df, vocabulary):
+    return replace_columns(
+        df,
+        COMPACT_POSTPROC_COLUMNS,
+        {
+            "diff_type": [[int(label) for label in seq] for seq in df["diff_type"]],
+            "default_seq": [to_tokens(ids, vocabulary) for ids in df["default_ids"]],
+            "correction_seq": [
+                to_tokens(ids, vocabulary) for ids in df["correction_ids"]
+            ],
+        },
+    )
+
+
+def read_compact_df(file_path, file_name):
+    # Compact columns as numpy arrays, whatever format they were saved in
+    df = utils.read_df(file_path, file_name)
+    for column in df.columns:
+        if column in COMPACT_LABEL_COLUMNS + COMPACT_POSTPROC_COLUMNS:
+            dtype = COMPACT_DTYPES.get(column, np.int32)
+            df[column] = [np.asarray(seq, dtype=dtype) for seq in df[column]]
+    return df
+
+
+def compact_data_files(lang_path, compact_path):
+    # Writes compact copies of all labeled and postproc transcripts under
+    # `lang_path` to `compact_path`, with the vocabulary they share
+    data_paths = {
+        name: PurePath(lang_path, name)
+        for name in ["labeled_transcripts", "postproc_transcripts"]
+    }
+    suffix = utils.STORAGE_SUFFIXES[config.STORAGE_FORMAT]
+    file_names = {
+        name: sorted(f.stem for f in Path(path).glob(f"*{suffix}"))
+        for name, path in data_paths.items()
+    }
+
+    def read_all(name):
+        return (utils.read_df(data_paths[name], f) for f in file_names[name])
+
+    vocabulary = build_vocabulary(
+        read_all("labeled_transcripts"), read_all("postproc_transcripts")
+    )
+    save_vocabulary(vocabulary, PurePath(compact_path, "vocabulary.json"))
+    token_ids = {token: i for i, token in enumerate(vocabulary)}
+    print(f"vocabulary of {len(vocabulary)} tokens")
+
+    encoders = {
+        "labeled_transcripts": encode_labeled,
+        "postproc_transcripts": encode_postproc,
+    }
+    for name, path in data_paths.items():
+        Path(compact_path, name).mkdir(parents=True, exist_ok=True)
+        for file_name in file_names[name]:
+            df = encoders[name](utils.read_df(path, file_name), token_ids)
+            utils.write_df(
+                df, PurePath(compact_path, name), file_name, orient=ORIENTS[name]
+            )
+            print(f"compacted {PurePath(path, file_name)}")
+
+
+def expand_data_files(compact_path, lang_path):
+    # Writes the compact files in `compact_path` back in the usual schema
+    vocabulary = load_vocabulary(PurePath(compact_path, "vocabulary.json"))
+    decoders = {
+        "labeled_transcripts": decode_labeled,
+        "postproc_transcripts": decode_postproc,
+    }
+    suffix = utils.STORAGE_SUFFIXES[config.STORAGE_FORMAT]
+    for name, decode in decoders.items():
+        Path(lang_path, name).mkdir(parents=True, exist_ok=True)
+        for f in sorted(Path(compact_path, name).glob(f"*{suffix}")):
+            df = decode(utils.read_df(f.parent, f.stem), vocabulary)
+            utils.write_df(df, PurePath(lang_path, name), f.stem, orient=ORIENTS[name])
+            print(f"expanded {f}")
@@ -3,20 +3,83 @@ from pathlib import PurePath
 ### Prefs ###
 DEVELOPER_KEY = "<API_KEY_HERE>"
 LANGUAGE = "en"
+# Only use saved data, never request from YouTube or download NLTK data
+OFFLINE = False
 CHANNEL_NAME = "Jeremy Howard"
 GET_CHANNEL_IDS_ONLY = False
 GET_PLAYLIST_IDS_ONLY = False
 GET_VIDEO_IDS_ONLY = False
 
+# Continue an interrupted request from its latest `i{N}_` checkpoint
+RESUME = True
+# Re-list an already saved channel, requesting transcripts of new videos only
+REFRESH = False
+
+# Only re-label videos whose raw transcripts (or the labeling, see
+# PIPELINE_VERSION in prepare_data.py) changed since labeled and postproc
+# transcripts were saved
+INCREMENTAL = True
+
 SAVE_INTERVAL = 100
 TRANSCRIPT_SAVE_INTERVAL = SAVE_INTERVAL
 
+# Playlists paged at once when listing the videos of a channel
+PLAYLIST_N_THREADS = 4
+
+# YouTube Data API requests, see youtube_api.py
+YOUTUBE_API_URL = "https://www.googleapis.com/youtube/v3"  # or a stand-in server
+API_QUOTA_LIMIT = 10_000  # units a run may spend, the default daily quota
+API_N_RETRIES = 3
+API_RETRY_BACKOFF = 1.0  # seconds, doubled on each retry
+# Reuse pages requested less than API_CACHE_MAX_AGE seconds ago (None: always),
+# saved in API_CACHE_PATH
+API_CACHE = True
+API_CACHE_MAX_AGE = 24 * 60 * 60
+API_CACHE_MAX_MB = 512
+
+# Concurrent transcript requests, rate limited over all threads
+TRANSCRIPT_N_THREADS = 4
+TRANSCRIPT_REQUESTS_PER_SEC = 5
+TRANSCRIPT_N_RETRIES = 3
+TRANSCRIPT_RETRY_BACKOFF = 1.0  # seconds, doubled on each retry
+
 PRINT_TRANSCRIPT_API_ERR = False
 USE_ONLY_POSTPROC_LABELS = True
 USE_VIDEO_ID_AS_IDX = False
 
 SPLIT_FILE_N_LINES = 3000
 
+# "differ": difflib.Differ, "opcodes": same diffs, skipping most intraline work,
+# "windowed": for long transcripts, only aligns the tokens between long exact
+# matches, in windows of up to DIFF_WINDOW_SIZE tokens
+DIFF_BACKEND = "opcodes"
+DIFF_WINDOW_SIZE = 2000
+DIFF_ANCHOR_LEN = 8  # tokens of an exact match to anchor on
+
+# Processes used to label videos, 1 runs in-process
+N_WORKERS = 1
+WORKER_CHUNKSIZE = 4
+# Channels postprocessed at once by `postprocess_data.py -c <channels...>`
+N_CHANNEL_WORKERS = 1
+
+# Reuse diffs of videos whose texts are unchanged, saved in DIFF_CACHE_PATH
+DIFF_CACHE = True
+DIFF_CACHE_MAX_MB = 1024  # least recently used diffs are removed past this, or None
+
+# Tokens remembered per normalization when classifying diff types
+TOKEN_CACHE_SIZE = 200_000
+# Keep those between runs, in TOKEN_CACHE_PATH
+PERSIST_TOKEN_CACHE = False
+
+# Per-stage timings and counters, see metrics.py. Set to a file path to save:
+METRICS_LOG_PATH = None  # each stage as a line of json
+METRICS_PROM_PATH = None  # totals in the Prometheus text format
+PROFILE_STAGES = False  # cProfile stats of each outermost stage in PROFILE_PATH
+
+# "json" or "parquet" (needs pyarrow) for saved channel data
+STORAGE_FORMAT = "json"
+
+
 ### Labels ###
 ## prepare_data
 BOTH_AGREE = 0
@@ -48,6 +111,18 @@ LANG_PATH = PurePath(TRANSCRIPTS_PATH, LANGUAGE)
 RAW_TRANSCRIPT_PATH = PurePath(LANG_PATH, "raw_transcripts")
 LABELED_TRANSCRIPT_PATH = PurePath(LANG_PATH, "labeled_transcripts")
 POSTPROC_TRANSCRIPT_PATH = PurePath(LANG_PATH, "postproc_transcripts")
+# token, diff type, channel and playlist lookups, see corpus_index.py
+POSTPROC_INDEX_PATH = PurePath(LANG_PATH, "postproc_index")
 
 SPLIT_LABELED_PATH = PurePath(LANG_PATH, "split")
+# int encoded copies of labeled and postproc transcripts, see compact.py
+COMPACT_PATH = PurePath(LANG_PATH, "compact")
 SPLIT_LABELED_FILENAME = "youtube_caption_corrections"
+# split postproc transcripts as memory mapped arrays, see shards.py
+SHARD_PATH = PurePath(LANG_PATH, "shards")
+
+CACHE_PATH = PurePath(PATH_ROOT, "cache")
+TOKEN_CACHE_PATH = PurePath(CACHE_PATH, "token_cache.json")
+DIFF_CACHE_PATH = PurePath(CACHE_PATH, "diffs")
+API_CACHE_PATH = PurePath(CACHE_PATH, "youtube_api")
+PROFILE_PATH = PurePath(PATH_ROOT, "profiles")
@@ -0,0 +1,68 @@
+import argparse
+import sys
+
+import compact
+import config
+import utils
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--from",
+        dest="from_format",
+        choices=utils.STORAGE_SUFFIXES,
+        default="json",
+        help="storage format of the saved data",
+    )
+    parser.add_argument(
+        "--to",
+        dest="to_format",
+        choices=utils.STORAGE_SUFFIXES,
+        default="parquet",
+        help="storage format to convert to",
+    )
+
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="write int encoded copies of labeled and postproc transcripts",
+    )
+    parser.add_argument(
+        "--expand",
+        action="store_true",
+        help="write the int encoded copies back in the usual schema",
+    )
+
+    args = parser.parse_args()
+
+    if args.compact or args.expand:
+        from_path, to_path = config.LANG_PATH, config.COMPACT_PATH
+        if args.expand:
+            from_path, to_path = to_path, from_path
+        input(
+            f"""
+        Running this file will write the labeled and postproc transcripts in:
+        {from_path}
+        to {to_path}, replacing any there already.
+        [Ctrl+c] to quit or [Enter] to continue.
+        """
+        )
+        if args.compact:
+            compact.compact_data_files(from_path, to_path)
+        else:
+            compact.expand_data_files(from_path, to_path)
+        sys.exit()
+
+    input(
+        f"""
+        Running this file will convert all {args.from_format} data files in:
+        {config.DATASET_PATH}
+        to {args.to_format}, next to the originals.
+        Set `STORAGE_FORMAT = "{args.to_format}"` in config.py to use them.
+        [Ctrl+c] to quit or [Enter] to continue.
+        """
+    )
+
+    utils.convert_data_files(config.DATASET_PATH, args.from_format, args.to_format)
@@ -0,0 +1,190 @@
+import json
+import numpy as np
+import pandas as pd
+
+from pathlib import Path, PurePath
+
+import config
+import utils
+
+# Inverted indexes over the postproc transcripts, saved as .npy arrays that
+# are memory mapped when queried, so a query only reads the postings it needs:
+#   tokens: default_seq token -> (video, position)
+#   diffs: diff_type -> (video, position, default token, correction token)
+# with the videos of each channel and playlist in meta.json.
+
+INDEX_ARRAYS = [
+    "token_offsets",
+    "token_videos",
+    "token_positions",
+    "diff_offsets",
+    "diff_videos",
+    "diff_positions",
+    "diff_default_ids",
+    "diff_correction_ids",
+]
+
+
+def postproc_file_stats(postproc_path):
+    suffix = utils.STORAGE_SUFFIXES[config.STORAGE_FORMAT]
+    return {
+        f.stem: [f.stat().st_size, f.stat().st_mtime_ns]
+        for f in sorted(Path(postproc_path).glob(f"*{suffix}"))
+    }
+
+
+def postings(keys, n_keys, *values):
+    # `values` sorted by key, with the offsets of each key's postings
+    order = np.argsort(keys, kind="stable")
+    offsets = np.zeros(n_keys + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(keys, minlength=n_keys))
+    return [offsets] + [value[order] for value in values]
+
+
+def build_index(postproc_path, index_path):
+    file_stats = postproc_file_stats(postproc_path)
+    videos = []
+    token_ids = {}
+    tokens = []  # per video: token ids of default_seq
+    diff_types = []
+    correction_ids = []
+
+    for file_name in file_stats:
+        df = utils.read_df(postproc_path, file_name)
+        video_ids = df["video_ids"] if "video_ids" in df else df.index
+        for video_id, t in zip(video_ids, df.itertuples()):
+            videos.append(
+                {
+                    "video_id": video_id,
+                    "file_name": file_name,
+                    "video_title": t.video_titles,
+                    "playlist_id": t.playlist_ids,
+                    "channel_id": t.channel_ids,
+                }
+            )
+            tokens.append(
+                [token_ids.setdefault(token, len(token_ids)) for token in t.default_seq]
+            )
+            correction_ids.append(
+                [
+                    token_ids.setdefault(token, len(token_ids))
+                    for token in t.correction_seq
+                ]
+            )
+            diff_types.append(t.diff_type)
+
+    lengths = np.array([len(seq) for seq in tokens], dtype=np.int64)
+    all_videos = np.repeat(np.arange(len(videos), dtype=np.int32), lengths)
+    all_positions = np.concatenate(
+        [np.arange(n, dtype=np.int32) for n in lengths] or [np.zeros(0, np.int32)]
+    )
+    all_tokens = np.fromiter(
+        (i for seq in tokens for i in seq), dtype=np.int32, count=lengths.sum()
+    )
+    all_corrections = np.fromiter(
+        (i for seq in correction_ids for i in seq), dtype=np.int32, count=lengths.sum()
+    )
+    all_diff_types = np.fromiter(
+        (label for seq in diff_types for label in seq),
+        dtype=np.int32,
+        count=lengths.sum(),
+    )
+
+    arrays = dict(
+        zip(
+            INDEX_ARRAYS[:3],
+            postings(all_tokens, len(token_ids), all_videos, all_positions),
+        )
+    )
+    is_diff = all_diff_types != 0
+    arrays.update(
+        zip(
+            INDEX_ARRAYS[3:],
+            postings(
+                all_diff_types[is_diff],
+                max(config.RESERVED_DIFF, all_diff_types.max(initial=0)) + 1,
+                all_videos[is_diff],
+                all_positions[is_diff],
+                all_tokens[is_diff],
+                all_corrections[is_diff],
+            ),
+        )
+    )
+
+    Path(index_path).mkdir(parents=True, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(str(PurePath(index_path, f"{name}.npy")), array)
+    meta = {
+        "files": file_stats,
+        "videos": videos,
+        "vocabulary": list(token_ids),
+    }
+    with open(PurePath(index_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    print(f"indexed {len(videos)} videos, {lengths.sum()} tokens")
+
+
+class CorpusIndex:
+    """Queries over the index saved by `build_index` in `index_path`. Results
+    are DataFrames with a row per video or per token position."""
+
+    def __init__(self, index_path):
+        with open(PurePath(index_path, "meta.json")) as f:
+            meta = json.load(f)
+        self.files = meta["files"]
+        self.videos = pd.DataFrame(meta["videos"])
+        self.vocabulary = meta["vocabulary"]
+        self.token_ids = {token: i for i, token in enumerate(self.vocabulary)}
+        self.channel_videos = self.videos.groupby("channel_id").indices
+        self.playlist_videos = self.videos.groupby("playlist_id").indices
+        self.arrays = {
+            name: np.load(str(PurePath(index_path, f"{name}.npy")), mmap_mode="r")
+            for name in INDEX_ARRAYS
+        }
+
+    def is_stale(self, postproc_path):
+        # True if postproc files were added, removed or rewritten since the build
+        return postproc_file_stats(postproc_path) != self.files
+
+    def postings(self, prefix, key):
+        offsets = self.arrays[f"{prefix}_offsets"]
+        if not 0 <= key < len(offsets) - 1:
+            return slice(0, 0)
+        return slice(int(offsets[key]), int(offsets[key + 1]))
+
+    def with_videos(self, video_idxs, **columns):
+        videos = self.videos.iloc[np.asarray(video_idxs)]
+        return pd.DataFrame({"video_ids": videos["video_id"].to_numpy(), **columns})
+
+    def token(self, token):
+        # Each position where `token` is in a default_seq
+        key = self.token_ids.get(token, -1)
+        s = self.postings("token", key)
+        return self.with_videos(
+            self.arrays["token_videos"][s],
+            position=np.array(self.arrays["token_positions"][s]),
+        )
+
+    def diff_type(self, diff_type):
+        # Each position labeled `diff_type`, e.g. config.DIGIT_DIFF
+        s = self.postings("diff", diff_type)
+        return self.with_videos(
+            self.arrays["diff_videos"][s],
+            position=np.array(self.arrays["diff_positions"][s]),
+            default_token=[
+                self.vocabulary[i] for i in self.arrays["diff_default_ids"][s]
+            ],
+            correction_token=[
+                self.vocabulary[i] for i in self.arrays["diff_correction_ids"][s]
+            ],
+        )
+
+    def channel(self, channel_id):
+        return self.videos.iloc[self.channel_videos.get(channel_id, [])]
+
+    def playlist(self, playlist_id):
+        return self.videos.iloc[self.playlist_videos.get(playlist_id, [])]
+
+
+if __name__ == "__main__":
+    build_index(config.POSTPROC_TRANSCRIPT_PATH, config.POSTPROC_INDEX_PATH)
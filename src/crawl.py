@@ -0,0 +1,361 @@
+import argparse
+import asyncio
+import sys
+import time
+import pandas as pd
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import config
+import metrics
+import utils
+import youtube_api
+import request_data
+
+# Crawls a channel with its phases (playlists of the channel, videos of each
+# playlist, transcripts of each video) running at once: a playlist is paged as
+# soon as it is listed, and a video's transcripts are fetched as soon as it is.
+# Phases are joined by bounded queues, so a fast phase waits for a slow one
+# instead of piling up work, and a crawl takes about as long as its slowest
+# phase. Requests block, so they run in threads.
+
+QUEUE_SIZE = 100  # items waiting between two phases
+PROGRESS_INTERVAL = 5  # seconds
+DONE = None  # put in a queue once per consumer, after the last item
+
+
+async def iter_pages(request_func, resource_id):
+    next_page_token = None
+    while True:
+        page = await asyncio.to_thread(request_func, resource_id, next_page_token)
+        request_data.check_n_results(page, resource_id)
+        yield page
+        next_page_token = page.get("nextPageToken")
+        if next_page_token is None:
+            return
+
+
+async def list_playlists(channel_id, playlist_queue, playlists, progress):
+    async for page in iter_pages(request_data.playlist_request_func, channel_id):
+        items = request_data.look_up_resources(
+            [page], request_data.REQUESTED_PLAYLIST_ITEMS
+        )
+        for playlist_id, title in zip(items["playlist_ids"], items["playlist_titles"]):
+            playlists.append({"playlist_ids": playlist_id, "playlist_titles": title})
+            progress["playlists listed"] += 1
+            await playlist_queue.put(playlist_id)
+
+
+async def list_videos(playlist_queue, video_queue, videos, progress):
+    # Only the first time a video is listed is kept, as in `request_video_ids`
+    while True:
+        playlist_id = await playlist_queue.get()
+        if playlist_id is DONE:
+            return
+        async for page in iter_pages(request_data.video_request_func, playlist_id):
+            items = request_data.look_up_resources(
+                [page], request_data.REQUESTED_VIDEO_ITEMS
+            )
+            for video_id, title in zip(items["video_ids"], items["video_titles"]):
+                if video_id in videos:
+                    continue
+                videos[video_id] = {"video_titles": title, "playlist_ids": playlist_id}
+                progress["videos listed"] += 1
+                await video_queue.put(video_id)
+        progress["playlists paged"] += 1
+
+
+async def fetch_video_transcripts(video_queue, fetch, transcripts, progress):
+    while True:
+        video_id = await video_queue.get()
+        if video_id is DONE:
+            return
+        if video_id in transcripts:  # saved by an interrupted crawl
+            continue
+        result = await asyncio.to_thread(fetch, video_id)
+        progress["videos fetched"] += 1
+        if result is not None:
+            transcripts[video_id] = result
+            progress["with transcripts"] += 1
+
+
+async def queue_saved_videos(video_ids, video_queue, progress):
+    # Videos listed by an earlier crawl, in place of listing them again
+    for video_id in video_ids:
+        progress["videos listed"] += 1
+        await video_queue.put(video_id)
+
+
+async def report_progress(progress, start):
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        counts = ", ".join(f"{n} {name}" for name, n in progress.items())
+        print(f"{time.perf_counter() - start:6.1f}s  {counts}")
+
+
+async def close_queue(queue, producers, n_consumers):
+    await asyncio.gather(*producers)
+    for _ in range(n_consumers):
+        await queue.put(DONE)
+
+
+async def crawl(
+    channel_id,
+    fetch,
+    transcripts,
+    n_playlist_workers,
+    n_fetch_workers,
+    saved_video_ids=None,
+):
+    # (playlists, videos) of the channel, adding the fetched transcripts of
+    # each video to `transcripts`. Given `saved_video_ids`, only their
+    # transcripts are fetched, and nothing is listed.
+    playlist_queue = asyncio.Queue(QUEUE_SIZE)
+    video_queue = asyncio.Queue(QUEUE_SIZE)
+    playlists = []
+    videos = {}
+    progress = Counter()
+
+    if saved_video_ids is None:
+        playlist_tasks = [
+            asyncio.create_task(
+                list_playlists(channel_id, playlist_queue, playlists, progress)
+            )
+        ]
+        video_tasks = [
+            asyncio.create_task(
+                list_videos(playlist_queue, video_queue, videos, progress)
+            )
+            for _ in range(n_playlist_workers)
+        ]
+        closing = [close_queue(playlist_queue, playlist_tasks, n_playlist_workers)]
+    else:
+        playlist_tasks = []
+        video_tasks = [
+            asyncio.create_task(
+                queue_saved_videos(saved_video_ids, video_queue, progress)
+            )
+        ]
+        closing = []
+    fetch_tasks = [
+        asyncio.create_task(
+            fetch_video_transcripts(video_queue, fetch, transcripts, progress)
+        )
+        for _ in range(n_fetch_workers)
+    ]
+    tasks = [*playlist_tasks, *video_tasks, *fetch_tasks]
+    progress_task = asyncio.create_task(report_progress(progress, time.perf_counter()))
+
+    try:
+        await asyncio.gather(
+            *tasks,
+            *closing,
+            close_queue(video_queue, video_tasks, n_fetch_workers),
+        )
+    finally:
+        # on an error, e.g. QuotaExceededError, the other phases are stopped
+        for task in [*tasks, progress_task]:
+            task.cancel()
+
+    counts = ", ".join(f"{n} {name}" for name, n in progress.items())
+    print(f"crawled {counts}")
+    return playlists, videos
+
+
+@metrics.timed_stage("crawl_channel")
+def crawl_channel(channel_id, file_name, lang, save_interval):
+    # Saves the playlists, videos and raw transcripts of the channel where
+    # `request_data.get_transcripts` does, so the other scripts read them.
+    # As there, saved files are reused unless REFRESH, and then only videos
+    # without saved transcripts are fetched.
+    raw_path = config.RAW_TRANSCRIPT_PATH
+    existing_df = None
+    if Path(utils.data_file_path(raw_path, file_name)).exists():
+        existing_df = utils.read_df(raw_path, file_name)
+        if not config.REFRESH:
+            print(f"reading {utils.data_file_path(raw_path, file_name)}")
+            return existing_df
+        print(f"refreshing {utils.data_file_path(raw_path, file_name)}")
+
+    saved_videos_df = None
+    if not config.REFRESH and all(
+        Path(utils.data_file_path(path, file_name)).exists()
+        for path in [config.PLAYLIST_PATH, config.VIDEO_PATH]
+    ):
+        saved_videos_df = utils.read_df(config.VIDEO_PATH, file_name)
+        print(f"reading {utils.data_file_path(config.VIDEO_PATH, file_name)}")
+
+    rate_limiter = None
+    if config.TRANSCRIPT_REQUESTS_PER_SEC:
+        rate_limiter = utils.RateLimiter(
+            config.TRANSCRIPT_REQUESTS_PER_SEC,
+            burst=config.TRANSCRIPT_REQUESTS_PER_SEC,
+        )
+    fetch = partial(
+        request_data.fetch_transcript,
+        lang=lang,
+        transcript_api=request_data.get_transcript_api(),
+        rate_limiter=rate_limiter,
+        n_retries=config.TRANSCRIPT_N_RETRIES,
+        backoff=config.TRANSCRIPT_RETRY_BACKOFF,
+    )
+
+    # transcripts are fetched in no set order, so all of them are saved and
+    # the saved ones skipped when resuming, as are those of `existing_df`
+    Path(raw_path).mkdir(parents=True, exist_ok=True)
+    transcripts = {}
+    if existing_df is not None:
+        transcripts = {
+            video_id: (autogen, manual)
+            for video_id, autogen, manual in zip(
+                existing_df.index, existing_df["autogen"], existing_df["manual"]
+            )
+        }
+    if config.RESUME:
+        checkpoint_df = utils.read_checkpoint_log(raw_path, file_name)
+        if checkpoint_df is not None and len(checkpoint_df) > 0:
+            transcripts.update(
+                {
+                    video_id: (autogen, manual)
+                    for video_id, autogen, manual in zip(
+                        checkpoint_df["video_ids"],
+                        checkpoint_df["autogen"],
+                        checkpoint_df["manual"],
+                    )
+                }
+            )
+    else:
+        utils.rem_checkpoint_log(raw_path, file_name)
+
+    saved_ids = set(transcripts)
+    if existing_df is not None:  # only new transcripts go in the checkpoint log
+        saved_ids.update(existing_df.index)
+
+    def save_checkpoint():
+        new_ids = [video_id for video_id in transcripts if video_id not in saved_ids]
+        utils.append_to_checkpoint_log(
+            pd.DataFrame(
+                {
+                    "video_ids": new_ids,
+                    "autogen": [transcripts[video_id][0] for video_id in new_ids],
+                    "manual": [transcripts[video_id][1] for video_id in new_ids],
+                }
+            ),
+            raw_path,
+            file_name,
+        )
+        saved_ids.update(new_ids)
+
+    n_playlist_workers = max(config.PLAYLIST_N_THREADS, 1)
+    n_fetch_workers = max(config.TRANSCRIPT_N_THREADS, 1)
+
+    async def crawl_and_save():
+        # a thread for each request that can be in flight at once
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(1 + n_playlist_workers + n_fetch_workers)
+        )
+        crawl_task = asyncio.create_task(
+            crawl(
+                channel_id,
+                fetch,
+                transcripts,
+                n_playlist_workers,
+                n_fetch_workers,
+                saved_video_ids=(
+                    None if saved_videos_df is None else saved_videos_df.index.tolist()
+                ),
+            )
+        )
+        try:
+            while not crawl_task.done():
+                await asyncio.wait([crawl_task], timeout=PROGRESS_INTERVAL)
+                if len(transcripts) - len(saved_ids) >= save_interval:
+                    save_checkpoint()
+            return crawl_task.result()
+        finally:
+            crawl_task.cancel()
+            save_checkpoint()
+
+    playlists, videos = asyncio.run(crawl_and_save())
+
+    if saved_videos_df is not None:
+        videos_df = saved_videos_df
+    else:
+        Path(config.PLAYLIST_PATH).mkdir(parents=True, exist_ok=True)
+        utils.write_df(pd.DataFrame(playlists), config.PLAYLIST_PATH, file_name)
+
+        videos_df = pd.DataFrame.from_dict(videos, orient="index")
+        videos_df.index.name = "video_ids"
+        videos_df["channel_ids"] = [channel_id] * len(videos_df)
+        Path(config.VIDEO_PATH).mkdir(parents=True, exist_ok=True)
+        utils.write_df(videos_df, config.VIDEO_PATH, file_name)
+
+    raw_transcripts_df = pd.DataFrame(
+        {
+            "autogen": {video_id: t[0] for video_id, t in transcripts.items()},
+            "manual": {video_id: t[1] for video_id, t in transcripts.items()},
+        }
+    )
+    raw_transcripts_df = videos_df.join(raw_transcripts_df, how="inner")
+    if existing_df is not None:  # saved videos stay, as in `request_raw_transcript`
+        raw_transcripts_df = pd.concat(
+            [
+                existing_df,
+                raw_transcripts_df.drop(existing_df.index, errors="ignore"),
+            ]
+        )
+    utils.write_df(raw_transcripts_df, raw_path, file_name)
+    utils.rem_checkpoint_log(raw_path, file_name)
+    return raw_transcripts_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-c",
+        "--channel",
+        default=config.CHANNEL_NAME,
+        help="YouTube channel name, also naming the saved files",
+    )
+    parser.add_argument(
+        "--channel_id",
+        default=None,
+        help="crawl this channel, rather than searching for the name",
+    )
+    parser.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        help="crawl the top search result without asking",
+    )
+
+    args = parser.parse_args()
+
+    file_name = "_".join(args.channel.split())
+    try:
+        channel_id = args.channel_id
+        if channel_id is None:
+            channel_ids_df = request_data.get_channel_ids(
+                args.channel, config.CHANNEL_PATH, file_name
+            )
+            channel_id = channel_ids_df["channel_ids"].tolist()[0]
+            if not args.yes:
+                request_data.confirm_channel(channel_id, file_name)
+
+        raw_transcripts_df = crawl_channel(
+            channel_id, file_name, config.LANGUAGE, config.TRANSCRIPT_SAVE_INTERVAL
+        )
+    except youtube_api.YouTubeApiError as e:
+        sys.exit(str(e))
+    finally:
+        metrics.save()
+    if len(raw_transcripts_df) == 0:
+        sys.exit("No manually generated transcripts on this channel")
+    # a stand-in client may not count quota, and none is made if nothing is listed
+    quota_used = getattr(request_data.YOUTUBE, "quota_used", None)
+    if quota_used is not None:
+        print(f"YouTube API quota units spent: {dict(quota_used)}")
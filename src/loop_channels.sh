@@ -1,7 +1,20 @@
 #!/bin/bash
-channels='3Blue1Brown Alfredo_Canziani Aurélien_Géron DeepMind Jeremy_Howard Khan_Academy Luis_Serrano minutephysics nature_video Pieter_Abbeel stanfordonline TED Veritasium Weights_&_Biases'
-for channel in $channels
-do
-    python src/postprocess_data.py -c $channel
-done
-echo All done
+channels=(
+    "3Blue1Brown"
+    "Alfredo_Canziani"
+    "Aurélien_Géron"
+    "DeepMind"
+    "Jeremy_Howard"
+    "Khan_Academy"
+    "Luis_Serrano"
+    "minutephysics"
+    "nature_video"
+    "Pieter_Abbeel"
+    "stanfordonline"
+    "TED"
+    "Veritasium"
+    "Weights_&_Biases"
+)
+# channels processed at once, unlike N_WORKERS in config.py, the processes
+# labeling the videos of each channel
+python src/postprocess_data.py -j "${N_CHANNEL_WORKERS:-4}" -c "${channels[@]}"
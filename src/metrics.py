@@ -0,0 +1,114 @@
+import cProfile
+import json
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path, PurePath
+
+import config
+
+PROMETHEUS_PREFIX = "yt_captions_"
+
+COUNTERS = defaultdict(float)  # (name, sorted label items) -> total
+LOCK = threading.Lock()
+PROFILING = threading.local()
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with LOCK:
+        COUNTERS[key] += value
+
+
+def snapshot():
+    with LOCK:
+        return [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(COUNTERS.items())
+        ]
+
+
+def log_event(event):
+    if config.METRICS_LOG_PATH is None:
+        return
+    line = json.dumps(event) + "\n"
+    with LOCK:
+        with open(config.METRICS_LOG_PATH, "a") as f:
+            f.write(line)
+
+
+@contextmanager
+def stage(name):
+    # Times the enclosed code as `name`. Counts put into the yielded dict,
+    # e.g. record["rows"] = len(df), are added up per stage as well.
+    record = {}
+    profiler = None
+    if config.PROFILE_STAGES and not getattr(PROFILING, "active", False):
+        # cProfile can't nest, so only the outermost stage is profiled
+        PROFILING.active = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+
+        if profiler is not None:
+            profiler.disable()
+            PROFILING.active = False
+            Path(config.PROFILE_PATH).mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(PurePath(config.PROFILE_PATH, f"{name}.prof")))
+
+        inc("stage_seconds_total", seconds, stage=name)
+        inc("stage_calls_total", 1, stage=name)
+        for count_name, value in record.items():
+            inc(f"{count_name}_total", value, stage=name)
+        log_event({"stage": name, "seconds": seconds, "time": time.time(), **record})
+
+
+def timed_stage(name):
+    # Decorator running the function as a `stage`, with its result's length as rows
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as record:
+                result = func(*args, **kwargs)
+                if hasattr(result, "__len__"):
+                    record["rows"] = len(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_prometheus(file_path):
+    # Totals in the Prometheus text format, e.g. for node_exporter's textfile collector
+    lines = []
+    typed = set()
+    for counter in snapshot():
+        name = PROMETHEUS_PREFIX + counter["name"]
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        labels = ",".join(
+            f'{k}="{escape_label(v)}"' for k, v in counter["labels"].items()
+        )
+        lines.append(f"{name}{{{labels}}} {counter['value']}")
+
+    with open(file_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def save():
+    if config.METRICS_PROM_PATH is not None:
+        write_prometheus(config.METRICS_PROM_PATH)
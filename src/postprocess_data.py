@@ -1,18 +1,21 @@
 import argparse
-import re
-import nltk
-
-from nltk.corpus import stopwords
-from nltk.stem.porter import PorterStemmer
-
-from pathlib import PurePath
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 from string import punctuation
 
 import config
+import metrics
 import utils
 import prepare_data
 
-nltk.download("stopwords")
+TOKEN_CACHES = None
 
 
 def get_autogen_reconstruct(example):
@@ -44,12 +47,10 @@ def get_manual_reconstruct(example):
     return manual_reconstruct
 
 
-def add_simple_single_token_diff_labels(t, tokenizer, stemmer, en_stopwords):
-
-    default_seq = get_autogen_reconstruct(t)
-    correction_seq = [""] * len(t.autogen_seq)
-    new_labels = [0] * len(t.autogen_seq)
-
+def get_single_token_diffs(t):
+    # (idx, auto_token, man_token) for mutual token differences where the same
+    # number of tokens differ in both sequences
+    token_diffs = []
     for idx in range(len(t.autogen_seq)):
         # Ingore if not a mutual token difference
         if t.is_autogen_unique[idx] == config.BOTH_DIFFER:
@@ -66,32 +67,116 @@ def add_simple_single_token_diff_labels(t, tokenizer, stemmer, en_stopwords):
                 continue  # Only labeling same len token diffs
             man_token = t.manual_seq[idx]
 
-            if auto_token.lower() == man_token.lower():
-                new_labels[idx] = config.CASE_DIFF
+            token_diffs.append((idx, auto_token, man_token))
+    return token_diffs
+
+
+def make_token_caches(tokenizer, stemmer, max_size=None):
+    # Token normalizations used to classify diffs. The same words come up in
+    # many videos, so each is memoized.
+    return {
+        "strip": utils.LRUCache(lambda token: token.strip(punctuation), max_size),
+        "lower_strip": utils.LRUCache(
+            lambda token: token.lower().strip(punctuation), max_size
+        ),
+        "stem": utils.LRUCache(stemmer.stem, max_size),
+        "intraword": utils.LRUCache(
+            lambda token: "".join(tokenizer.tokenize(token)).lower().strip(punctuation),
+            max_size,
+        ),
+    }
+
+
+def get_token_caches():
+    # Shared by all transcripts postprocessed in this process
+    global TOKEN_CACHES
+    if TOKEN_CACHES is None:
+        import nltk
+        from nltk.stem.porter import PorterStemmer
+
+        TOKEN_CACHES = make_token_caches(
+            nltk.RegexpTokenizer(r"\w+"), PorterStemmer(), config.TOKEN_CACHE_SIZE
+        )
+        if config.PERSIST_TOKEN_CACHE:
+            load_token_caches(TOKEN_CACHES, config.TOKEN_CACHE_PATH)
+    return TOKEN_CACHES
+
+
+def load_token_caches(token_caches, file_path):
+    try:
+        with open(file_path) as f:
+            saved_caches = json.load(f)
+    except (FileNotFoundError, ValueError):
+        # e.g. a file cut short by a crash, the caches are just rebuilt
+        return
+    for name, items in saved_caches.items():
+        if name in token_caches:
+            token_caches[name].load(items)
+
+
+def save_token_caches(token_caches, file_path):
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    # written whole then renamed, so a crash never leaves part of a file
+    tmp_path = Path(file_path).with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({name: cache.items() for name, cache in token_caches.items()}, f)
+    os.replace(tmp_path, file_path)
+
+
+def map_unique(tokens, func):
+    # Applies `func` once per distinct token, as tokens repeat a lot
+    return tokens.map({token: func(token) for token in tokens.unique()})
+
+
+def classify_token_diffs(auto_tokens, man_tokens, token_caches):
+    auto = pd.Series(auto_tokens, dtype=object)
+    man = pd.Series(man_tokens, dtype=object)
+
+    auto_lower, man_lower = auto.str.lower(), man.str.lower()
+
+    def same(tokens_a, tokens_b, cache_name):
+        cache = token_caches[cache_name]
+        return map_unique(tokens_a, cache) == map_unique(tokens_b, cache)
+
+    # Checked in order, a pair gets the label of the first matching condition
+    conditions_and_labels = [
+        (lambda: auto_lower == man_lower, config.CASE_DIFF),
+        (lambda: same(auto, man, "strip"), config.PUNCUATION_DIFF),
+        (lambda: same(auto, man, "lower_strip"), config.CASE_AND_PUNCUATION_DIFF),
+        (lambda: same(auto_lower, man_lower, "stem"), config.STEM_BASED_DIFF),
+        #  E.g. `2` <-> `two` is a common diff
+        (
+            lambda: man.str.match(r"\d+") | auto.str.match(r"\d+"),
+            config.DIGIT_DIFF,
+        ),
+        (lambda: same(auto, man, "intraword"), config.INTRAWORD_PUNC_DIFF),
+    ]
+
+    labels = np.full(len(auto), config.UNKNOWN_TYPE_DIFF)
+    unlabeled = np.ones(len(auto), dtype=bool)
+    for condition, label in conditions_and_labels:
+        if not unlabeled.any():
+            break
+        matches = condition().to_numpy(dtype=bool) & unlabeled
+        labels[matches] = label
+        unlabeled &= ~matches
+    return labels.tolist()
+
+
+def add_simple_single_token_diff_labels(t, token_caches=None):
 
-            elif auto_token.strip(punctuation) == man_token.strip(punctuation):
-                new_labels[idx] = config.PUNCUATION_DIFF
-
-            elif auto_token.lower().strip(punctuation) == man_token.lower().strip(
-                punctuation
-            ):
-                new_labels[idx] = config.CASE_AND_PUNCUATION_DIFF
-
-            elif stemmer.stem(auto_token.lower()) == stemmer.stem(man_token.lower()):
-                new_labels[idx] = config.STEM_BASED_DIFF
-
-            #  E.g. `2` <-> `two` is a common diff
-            elif re.match("\d+", man_token) or re.match("\d+", auto_token):
-                new_labels[idx] = config.DIGIT_DIFF
-
-            elif "".join(tokenizer.tokenize(auto_token)).lower().strip(
-                punctuation
-            ) == "".join(tokenizer.tokenize(man_token)).lower().strip(punctuation):
-                new_labels[idx] = config.INTRAWORD_PUNC_DIFF
-
-            else:
-                new_labels[idx] = config.UNKNOWN_TYPE_DIFF
+    default_seq = get_autogen_reconstruct(t)
+    correction_seq = [""] * len(t.autogen_seq)
+    new_labels = [0] * len(t.autogen_seq)
 
+    token_diffs = get_single_token_diffs(t)
+    if token_diffs:
+        idxs, auto_tokens, man_tokens = zip(*token_diffs)
+        if token_caches is None:
+            token_caches = get_token_caches()
+        labels = classify_token_diffs(auto_tokens, man_tokens, token_caches)
+        for idx, man_token, label in zip(idxs, man_tokens, labels):
+            new_labels[idx] = label
             correction_seq[idx] = man_token
 
     t["diff_type"] = new_labels
@@ -100,70 +185,128 @@ def add_simple_single_token_diff_labels(t, tokenizer, stemmer, en_stopwords):
     return t
 
 
-def prepare_postproc_transcripts(labeled_transcripts_df, file_path, file_name):
+@metrics.timed_stage("add_diff_type_labels")
+def add_diff_type_labels(transcripts, token_caches):
+    # Same labels as `add_simple_single_token_diff_labels`, but classifying
+    # the token diffs of all videos at once
+    transcripts = transcripts.copy()
+    # lists, as `get_single_token_diffs` splits tokens in place, and these may
+    # be arrays as read from parquet
+    for column in ["manual_seq", "manual_addl_rep"]:
+        transcripts[column] = transcripts[column].map(list)
+
+    all_token_diffs = [get_single_token_diffs(t) for t in transcripts.itertuples()]
+    flat_token_diffs = [token_diff for diffs in all_token_diffs for token_diff in diffs]
+    labels = classify_token_diffs(
+        [auto_token for _, auto_token, _ in flat_token_diffs],
+        [man_token for _, _, man_token in flat_token_diffs],
+        token_caches,
+    )
 
-    tokenizer = nltk.RegexpTokenizer(r"\w+")
-    stemmer = PorterStemmer()
-    en_stopwords = stopwords.words("english")
+    diff_types = []
+    correction_seqs = []
+    labels = iter(labels)
+    for t, token_diffs in zip(transcripts.itertuples(), all_token_diffs):
+        new_labels = [0] * len(t.autogen_seq)
+        correction_seq = [""] * len(t.autogen_seq)
+        for idx, _, man_token in token_diffs:
+            new_labels[idx] = next(labels)
+            correction_seq[idx] = man_token
+        diff_types.append(new_labels)
+        correction_seqs.append(correction_seq)
+
+    transcripts["diff_type"] = diff_types
+    transcripts["default_seq"] = [
+        get_autogen_reconstruct(t) for t in transcripts.itertuples()
+    ]
+    transcripts["correction_seq"] = correction_seqs
+    return transcripts
 
-    transcripts = labeled_transcripts_df.apply(
-        add_simple_single_token_diff_labels,
-        axis=1,
-        args=(tokenizer, stemmer, en_stopwords),
-    )
+
+@metrics.timed_stage("prepare_postproc_transcripts")
+def prepare_postproc_transcripts(
+    labeled_transcripts_df, file_path, file_name, existing_df=None
+):
+    labeled_df = labeled_transcripts_df
+    fingerprints = prepare_data.video_fingerprints(labeled_transcripts_df)
+
+    if existing_df is not None and "video_ids" not in existing_df:
+        existing_df = None  # saved without video ids, so all are labeled again
+    if existing_df is not None:  # only label new and changed videos
+        saved_df = existing_df
+        existing_df = existing_df.set_index("video_ids")
+        unchanged = list(
+            prepare_data.unchanged_videos(fingerprints, file_path, file_name)
+        )
+        is_kept = existing_df.index.isin(unchanged)
+        labeled_df = labeled_df[~labeled_df.index.isin(unchanged)]
+        n_removed = (~existing_df.index.isin(list(fingerprints))).sum()
+        print(
+            f"{len(labeled_df)} new or changed videos, {n_removed} removed, "
+            f"{is_kept.sum()} unchanged"
+        )
+        if len(labeled_df) == 0 and n_removed == 0:
+            return saved_df
+
+    token_caches = get_token_caches()
+
+    transcripts = add_diff_type_labels(labeled_df, token_caches)
+
+    for name, cache in token_caches.items():
+        print(f"{name} cache: {cache.hit_rate():.1%} hit rate, {len(cache)} tokens")
+    if config.PERSIST_TOKEN_CACHE:
+        save_token_caches(token_caches, config.TOKEN_CACHE_PATH)
 
     if config.USE_ONLY_POSTPROC_LABELS:
-        transcripts = transcripts[
-            [
-                "video_titles",
-                "playlist_ids",
-                "channel_ids",
-                "diff_type",
-                "default_seq",
-                "correction_seq",
-            ]
+        columns = [
+            "video_titles",
+            "playlist_ids",
+            "channel_ids",
+            "diff_type",
+            "default_seq",
+            "correction_seq",
         ]
+        # labeled before token timings were kept
+        if prepare_data.TIMING_COLUMN in transcripts:
+            columns.append(prepare_data.TIMING_COLUMN)
+        transcripts = transcripts[columns]
+    if existing_df is not None:
+        transcripts = prepare_data.merge_videos(
+            existing_df[is_kept], transcripts, labeled_transcripts_df.index
+        )
     if not config.USE_VIDEO_ID_AS_IDX:
         transcripts = transcripts.reset_index().rename(columns={"index": "video_ids"})
 
-    transcripts.to_json(str(PurePath(file_path, f"{file_name}.json")), orient="records")
+    utils.write_df(transcripts, file_path, file_name, orient="records")
+    utils.write_fingerprints(fingerprints, file_path, file_name)
     return transcripts
 
 
-def get_labeled_transcripts(channel_name, file_path, file_name):
+def get_labeled_transcripts(raw_transcripts_df, file_path, file_name):
     labeled_transcripts_df = utils.open_file_or_create(
         prepare_data.prepare_labeled_transcripts,
         raw_transcripts_df,
         file_path,
         file_name,
+        refresh=config.INCREMENTAL,
+        n_workers=config.N_WORKERS,
+        chunksize=config.WORKER_CHUNKSIZE,
     )
     return labeled_transcripts_df
 
 
-def get_postproc_transcripts(raw_transcripts_df, file_path, file_name):
+def get_postproc_transcripts(labeled_transcripts_df, file_path, file_name):
     postproc_transcripts_df = utils.open_file_or_create(
         prepare_postproc_transcripts,
         labeled_transcripts_df,
         file_path,
         file_name,
+        refresh=config.INCREMENTAL,
     )
     return postproc_transcripts_df
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-
-    parser.add_argument(
-        "-c", "--channel", action="store", default=None, help="YouTube channel name"
-    )
-
-    args = parser.parse_args()
-
-    if args.channel == None:
-        channel_name = config.CHANNEL_NAME
-    else:
-        channel_name = args.channel
-
+def postprocess_channel(channel_name):
     file_name = "_".join(channel_name.split())
 
     raw_transcripts_df = prepare_data.get_video_transcripts(
@@ -181,3 +324,65 @@ if __name__ == "__main__":
     postproc_transcripts_df = get_postproc_transcripts(
         labeled_transcripts_df, config.POSTPROC_TRANSCRIPT_PATH, file_name
     )
+    return postproc_transcripts_df
+
+
+def run_channel(channel_name):
+    # (channel_name, error or None, n_videos, seconds) for the batch report
+    start = time.perf_counter()
+    try:
+        n_videos = len(postprocess_channel(channel_name))
+    except (Exception, SystemExit) as e:
+        return channel_name, repr(e), 0, time.perf_counter() - start
+    return channel_name, None, n_videos, time.perf_counter() - start
+
+
+def postprocess_channels(channel_names, n_workers=1):
+    # Yields `run_channel` results as channels finish, `n_workers` at a time
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(run_channel, name) for name in channel_names]
+            for future in as_completed(futures):
+                yield future.result()
+    else:
+        yield from map(run_channel, channel_names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-c",
+        "--channel",
+        nargs="+",
+        default=None,
+        help="YouTube channel name(s)",
+    )
+    parser.add_argument(
+        "-j",
+        "--n_channel_workers",
+        type=int,
+        default=config.N_CHANNEL_WORKERS,
+        help="number of channels processed at once",
+    )
+
+    args = parser.parse_args()
+
+    if args.channel == None:
+        channel_names = [config.CHANNEL_NAME]
+    else:
+        channel_names = args.channel
+
+    n_failed = 0
+    for channel_name, error, n_videos, seconds in postprocess_channels(
+        channel_names, args.n_channel_workers
+    ):
+        if error is None:
+            print(f"done   {channel_name}: {n_videos} videos in {seconds:.1f}s")
+        else:
+            n_failed += 1
+            print(f"FAILED {channel_name} after {seconds:.1f}s: {error}")
+
+    print(f"{len(channel_names) - n_failed}/{len(channel_names)} channels done")
+    metrics.save()
+    sys.exit(1 if n_failed else 0)
@@ -1,32 +1,223 @@
-from pathlib import PurePath
-from difflib import Differ
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from difflib import Differ, SequenceMatcher
+import json
+import numpy as np
+import pandas as pd
 
 import config
+import metrics
 import utils
-import request_data
 
 
 AUTOGEN_UNIQUE = "-"
 MANUAL_UNIQUE = "+"
 
+LABEL_COLUMNS = [
+    "diffs",
+    "common_to_both_seq",
+    "is_autogen_unique",
+    "is_manual_unique",
+    "autogen_seq",
+    "manual_seq",
+    "manual_addl_rep",
+]
+# float32 start time (s) of each position of the label sequences
+TIMING_COLUMN = "token_starts"
+
+
+def extract_lines(transcript):
+    # Lines up to the last one to start, raising IndexError if there are none
+    last_line = transcript[-1]["start"]
+    lines = []
+    for line in transcript:
+
+        if line["start"] <= last_line:
+            lines.append(line)
+        else:
+            break
 
-def extract_text(transcript):
-    try:
-        last_line = transcript[-1]["start"]
-        text = []
-        for line in transcript:
+    return lines
 
-            if line["start"] <= last_line:
-                text.append(line["text"])
-            else:
-                break
 
-        return " ".join(text)
+def extract_text(transcript):
+    try:
+        return " ".join(line["text"] for line in extract_lines(transcript))
     except IndexError:
         return "extract_text_error"
 
 
-def generate_diff(transcript_texts):
+def extract_token_starts(transcript):
+    # Start time (s) of each token of `extract_text(transcript)`, spreading the
+    # tokens of a line evenly until it ends or the next line starts (autogen
+    # lines overlap), so that times don't go back
+    try:
+        lines = extract_lines(transcript)
+    except IndexError:
+        return np.zeros(0, dtype=np.float32)
+
+    starts = []
+    for line, next_line in zip(lines, lines[1:] + [None]):
+        n_tokens = len(line["text"].split())
+        duration = line.get("duration", 0.0)
+        if next_line is not None:
+            duration = max(min(duration, next_line["start"] - line["start"]), 0.0)
+        step = duration / max(n_tokens, 1)
+        starts.extend(line["start"] + step * i for i in range(n_tokens))
+    return np.array(starts, dtype=np.float32)
+
+
+def label_token_starts(is_autogen_unique, autogen_starts):
+    # Start times aligned with the label sequences. Manual inserts have no
+    # autogen token, so they get the start of the next one (or the last one).
+    is_autogen_token = np.array(is_autogen_unique) != config.MANUAL_INSERT
+    if len(autogen_starts) == 0:
+        return np.full(len(is_autogen_token), np.nan, dtype=np.float32)
+    autogen_idxs = np.cumsum(is_autogen_token) - is_autogen_token
+    return np.asarray(autogen_starts, dtype=np.float32)[
+        np.minimum(autogen_idxs, len(autogen_starts) - 1)
+    ]
+
+
+def differ_compare(autogen, manual):
+    return Differ().compare(autogen, manual)
+
+
+def opcode_compare(autogen, manual):
+    # Same lines as `Differ.compare`, but the intraline `?` hints of Differ's
+    # fancy replace are only computed for 'replace' blocks where they can change
+    # the diffs, i.e. where Differ may sync on a token common to both sides.
+    # Otherwise the '-'/'+' order within a block does not matter, as all of them
+    # end up in the same `diff_cache`.
+    token_ids = {}
+    autogen_ids = [token_ids.setdefault(token, len(token_ids)) for token in autogen]
+    manual_ids = [token_ids.setdefault(token, len(token_ids)) for token in manual]
+
+    d = Differ()
+    matcher = SequenceMatcher(None, autogen_ids, manual_ids)
+    for tag, alo, ahi, blo, bhi in matcher.get_opcodes():
+        if tag == "equal":
+            for token in autogen[alo:ahi]:
+                yield "  " + token
+        elif tag == "replace" and not set(autogen_ids[alo:ahi]).isdisjoint(
+            manual_ids[blo:bhi]
+        ):
+            yield from d._fancy_replace(autogen, alo, ahi, manual, blo, bhi)
+        else:
+            for token in autogen[alo:ahi]:
+                yield "- " + token
+            for token in manual[blo:bhi]:
+                yield "+ " + token
+
+
+def find_anchors(autogen_ids, manual_ids, anchor_len):
+    # Runs of `anchor_len` tokens found exactly once in each sequence, as
+    # (autogen, manual) start positions. Of those, the longest chain in the
+    # same order in both is kept, so the anchors never cross.
+    def unique_runs(ids):
+        runs = list(zip(*(ids[i:] for i in range(anchor_len))))
+        counts = Counter(runs)
+        return {run: i for i, run in enumerate(runs) if counts[run] == 1}
+
+    manual_runs = unique_runs(manual_ids)
+    pairs = [
+        (a, manual_runs[run])
+        for run, a in unique_runs(autogen_ids).items()
+        if run in manual_runs
+    ]
+    pairs.sort()
+
+    # longest increasing subsequence of the manual positions
+    tails = []  # manual position ending each chain length
+    tail_idxs = []
+    prev_idxs = []
+    for idx, (_, b) in enumerate(pairs):
+        length = bisect_left(tails, b)
+        if length == len(tails):
+            tails.append(b)
+            tail_idxs.append(idx)
+        else:
+            tails[length] = b
+            tail_idxs[length] = idx
+        prev_idxs.append(tail_idxs[length - 1] if length else None)
+
+    anchors = []
+    idx = tail_idxs[-1] if tail_idxs else None
+    while idx is not None:
+        anchors.append(pairs[idx])
+        idx = prev_idxs[idx]
+    return anchors[::-1]
+
+
+def gap_compare(autogen, manual, window_size):
+    # Tokens between anchors. Gaps longer than a window are diffed in
+    # windows, paired proportionally to the length of each side.
+    n_windows = -(-max(len(autogen), len(manual)) // window_size)
+    if n_windows <= 1:
+        yield from opcode_compare(autogen, manual)
+        return
+    for i in range(n_windows):
+        yield from opcode_compare(
+            autogen[
+                len(autogen) * i // n_windows : len(autogen) * (i + 1) // n_windows
+            ],
+            manual[len(manual) * i // n_windows : len(manual) * (i + 1) // n_windows],
+        )
+
+
+def windowed_compare(autogen, manual):
+    # For long transcripts: only the tokens between exactly matching anchors
+    # are aligned, so the cost grows with the length rather than its square.
+    # Transcripts shorter than a window are diffed like "opcodes".
+    window_size = config.DIFF_WINDOW_SIZE
+    if len(autogen) + len(manual) <= 2 * window_size:
+        yield from opcode_compare(autogen, manual)
+        return
+
+    token_ids = {}
+    autogen_ids = [token_ids.setdefault(token, len(token_ids)) for token in autogen]
+    manual_ids = [token_ids.setdefault(token, len(token_ids)) for token in manual]
+
+    autogen_idx = manual_idx = 0
+    for a, b in find_anchors(autogen_ids, manual_ids, config.DIFF_ANCHOR_LEN):
+        if a < autogen_idx or b < manual_idx:
+            continue  # within the match of an earlier anchor
+        yield from gap_compare(
+            autogen[autogen_idx:a], manual[manual_idx:b], window_size
+        )
+        while a < len(autogen) and b < len(manual) and autogen_ids[a] == manual_ids[b]:
+            yield "  " + autogen[a]
+            a += 1
+            b += 1
+        autogen_idx, manual_idx = a, b
+
+    yield from gap_compare(autogen[autogen_idx:], manual[manual_idx:], window_size)
+
+
+DIFF_BACKENDS = {
+    "differ": differ_compare,
+    "opcodes": opcode_compare,
+    "windowed": windowed_compare,
+}
+# Part of the diff cache keys, bump when `generate_diff` output changes
+DIFF_VERSION = 1
+# Settings of config.py the diffs of each backend depend on
+DIFF_BACKEND_SETTINGS = {"windowed": ["DIFF_WINDOW_SIZE", "DIFF_ANCHOR_LEN"]}
+
+
+def diff_settings(diff_backend=None):
+    # The backend and its settings, as part of cache keys and fingerprints
+    diff_backend = diff_backend or config.DIFF_BACKEND
+    settings = {
+        name: getattr(config, name)
+        for name in DIFF_BACKEND_SETTINGS.get(diff_backend, [])
+    }
+    return json.dumps({"diff_backend": diff_backend, **settings})
+
+
+def generate_diff(transcript_texts, diff_backend=None):
     ## from https://docs.python.org/3/library/difflib.html#difflib.Differ
     #################### d.compare symbols ######################
     # '- ' # line unique to sequence 1
@@ -40,11 +231,12 @@ def generate_diff(transcript_texts):
     autogen = transcript_texts["autogen_text"].split()
     manual = transcript_texts["manual_text"].split()
 
-    d = Differ()
+    compare = DIFF_BACKENDS[diff_backend or config.DIFF_BACKEND]
 
-    comp = list(d.compare(autogen, manual))
     # ignoring symbol for 'line not present in either input sequence'
-    comp = [element for element in comp if not element.startswith("?")]
+    comp = [
+        element for element in compare(autogen, manual) if not element.startswith("?")
+    ]
 
     index = 0
     element = comp[index]
@@ -75,7 +267,8 @@ def generate_diff(transcript_texts):
     return diffs
 
 
-def label_diff_targets(transcript):
+def label_diff_targets(transcript, autogen_starts=None):
+    # `autogen_starts`, from `extract_token_starts`, adds TIMING_COLUMN
 
     common_to_both_seq = []
     is_autogen_unique = []
@@ -134,39 +327,222 @@ def label_diff_targets(transcript):
     transcript["manual_seq"] = manual_seq
     transcript["manual_addl_rep"] = manual_addl_rep
 
+    if autogen_starts is not None:
+        transcript[TIMING_COLUMN] = label_token_starts(
+            is_autogen_unique, autogen_starts
+        )
+
     return transcript
 
 
+def diff_and_label(transcript_texts, diff_backend=None):
+    # With several workers, these stages are timed in (and stay in) the workers
+    with metrics.stage("generate_diff"):
+        transcript = {"diffs": generate_diff(transcript_texts, diff_backend)}
+    with metrics.stage("label_diff_targets"):
+        return label_diff_targets(transcript, transcript_texts.get("autogen_starts"))
+
+
+def label_transcripts(transcript_texts, n_workers=1, chunksize=1):
+    # Videos are independent, so they can be fanned out over processes.
+    # `map` streams results back in the order of `transcript_texts`.
+    label_func = partial(diff_and_label, diff_backend=config.DIFF_BACKEND)
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            yield from executor.map(label_func, transcript_texts, chunksize=chunksize)
+    else:
+        yield from map(label_func, transcript_texts)
+
+
+# Part of the video fingerprints, bump when labeled or postproc output changes
+PIPELINE_VERSION = 1
+# Settings of config.py the labeled and postproc outputs depend on
+LABEL_SETTINGS = [
+    "BOTH_AGREE",
+    "BOTH_DIFFER",
+    "AUTOGEN_INSERT",
+    "MANUAL_INSERT",
+    "CASE_DIFF",
+    "PUNCUATION_DIFF",
+    "CASE_AND_PUNCUATION_DIFF",
+    "STEM_BASED_DIFF",
+    "DIGIT_DIFF",
+    "INTRAWORD_PUNC_DIFF",
+    "UNKNOWN_TYPE_DIFF",
+    "RESERVED_DIFF",
+    "USE_ONLY_POSTPROC_LABELS",
+    "USE_VIDEO_ID_AS_IDX",
+]
+
+
+def fingerprint_lines(transcript):
+    # What the labels depend on, with times rounded, as they are read back from
+    # json a little off
+    try:
+        return [
+            (line["text"], round(line["start"], 3), round(line.get("duration", 0), 3))
+            for line in transcript
+        ]
+    except (TypeError, KeyError):
+        return transcript
+
+
+def video_fingerprints(transcripts):
+    # {video_id: hash of its raw transcripts and of how they are labeled}
+    label_settings = json.dumps(
+        {name: getattr(config, name) for name in LABEL_SETTINGS}
+    )
+    return {
+        video_id: utils.DiskCache.key(
+            PIPELINE_VERSION,
+            DIFF_VERSION,
+            diff_settings(),
+            label_settings,
+            json.dumps(fingerprint_lines(autogen), default=str),
+            json.dumps(fingerprint_lines(manual), default=str),
+        )
+        for video_id, autogen, manual in zip(
+            transcripts.index, transcripts["autogen"], transcripts["manual"]
+        )
+    }
+
+
+def unchanged_videos(fingerprints, file_path, file_name):
+    # Videos of `fingerprints` with the same fingerprint as when last saved
+    saved_fingerprints = utils.read_fingerprints(file_path, file_name)
+    return {
+        video_id
+        for video_id, fingerprint in fingerprints.items()
+        if saved_fingerprints.get(video_id) == fingerprint
+    }
+
+
+def merge_videos(kept_df, new_df, video_ids):
+    # Rows of both, in the order of `video_ids`
+    positions = {video_id: i for i, video_id in enumerate(video_ids)}
+    merged_df = pd.concat([kept_df, new_df])
+    order = np.argsort([positions[video_id] for video_id in merged_df.index])
+    return merged_df.iloc[order]
+
+
+def get_diff_cache():
+    if not config.DIFF_CACHE:
+        return None
+    max_bytes = config.DIFF_CACHE_MAX_MB * 2 ** 20 if config.DIFF_CACHE_MAX_MB else None
+    return utils.DiskCache(config.DIFF_CACHE_PATH, max_bytes)
+
+
+def diff_cache_key(transcript_texts, diff_backend=None):
+    return utils.DiskCache.key(
+        DIFF_VERSION,
+        diff_settings(diff_backend),
+        transcript_texts["autogen_text"],
+        transcript_texts["manual_text"],
+    )
+
+
+def label_transcripts_cached(transcript_texts, diff_cache, n_workers=1, chunksize=1):
+    # Only videos without cached diffs are diffed (by `label_transcripts`),
+    # the others are just labeled. Lookups and saves stay in this process.
+    keys = [diff_cache_key(texts) for texts in transcript_texts]
+    cached_diffs = [diff_cache.get(key) for key in keys]
+    missed_texts = [
+        texts for texts, diffs in zip(transcript_texts, cached_diffs) if diffs is None
+    ]
+    new_labels = label_transcripts(missed_texts, n_workers, chunksize)
+
+    for texts, key, diffs in zip(transcript_texts, keys, cached_diffs):
+        if diffs is None:
+            label = next(new_labels)
+            diff_cache.put(key, label["diffs"])
+        else:
+            label = label_diff_targets({"diffs": diffs}, texts.get("autogen_starts"))
+        yield label
+
+    metrics.inc("cache_hits_total", diff_cache.hits, cache="diffs")
+    metrics.inc("cache_misses_total", diff_cache.misses, cache="diffs")
+    n_evicted = diff_cache.evict()
+    print(
+        f"diff cache: {diff_cache.hit_rate():.1%} hit rate, {n_evicted} entries evicted"
+    )
+
+
+@metrics.timed_stage("prepare_labeled_transcripts")
 def prepare_labeled_transcripts(
     raw_transcripts_df,
     file_path,
     file_name,
+    n_workers=1,
+    chunksize=1,
+    existing_df=None,
 ):
     transcripts = raw_transcripts_df
-
-    transcripts["autogen_text"] = transcripts["autogen"].apply(extract_text)
-    malformed = transcripts["autogen_text"] == "extract_text_error"
-    transcripts.drop(index=transcripts[malformed].index, inplace=True)
-
-    transcripts["manual_text"] = transcripts["manual"].apply(extract_text)
-    malformed = transcripts["manual_text"] == "extract_text_error"
-    transcripts.drop(index=transcripts[malformed].index, inplace=True)
-
-    transcripts["diffs"] = transcripts[["autogen_text", "manual_text"]].apply(
-        generate_diff, axis=1
-    )
-    transcripts = transcripts.apply(label_diff_targets, axis=1)
-
-    transcripts.to_json(str(PurePath(file_path, f"{file_name}.json")))
+    fingerprints = video_fingerprints(raw_transcripts_df)
+
+    if existing_df is not None:  # only label new and changed videos
+        unchanged = list(unchanged_videos(fingerprints, file_path, file_name))
+        is_kept = existing_df.index.isin(unchanged)
+        transcripts = raw_transcripts_df[
+            ~raw_transcripts_df.index.isin(unchanged)
+        ].copy()
+        n_removed = (~existing_df.index.isin(list(fingerprints))).sum()
+        print(
+            f"{len(transcripts)} new or changed videos, {n_removed} removed, "
+            f"{is_kept.sum()} unchanged"
+        )
+        if len(transcripts) == 0 and n_removed == 0:
+            return existing_df
+
+    with metrics.stage("extract_text") as record:
+        transcripts["autogen_text"] = transcripts["autogen"].apply(extract_text)
+        malformed = transcripts["autogen_text"] == "extract_text_error"
+        transcripts.drop(index=transcripts[malformed].index, inplace=True)
+
+        transcripts["manual_text"] = transcripts["manual"].apply(extract_text)
+        malformed = transcripts["manual_text"] == "extract_text_error"
+        transcripts.drop(index=transcripts[malformed].index, inplace=True)
+
+        autogen_starts = transcripts["autogen"].map(extract_token_starts)
+        record["rows"] = len(transcripts)
+
+    with metrics.stage("label_transcripts") as record:
+        transcript_texts = transcripts[["autogen_text", "manual_text"]].to_dict(
+            "records"
+        )
+        for texts, starts in zip(transcript_texts, autogen_starts):
+            texts["autogen_starts"] = starts
+        diff_cache = get_diff_cache()
+        if diff_cache is None:
+            labels = label_transcripts(transcript_texts, n_workers, chunksize)
+        else:
+            labels = label_transcripts_cached(
+                transcript_texts, diff_cache, n_workers, chunksize
+            )
+        labels = list(labels)
+        for column in LABEL_COLUMNS + [TIMING_COLUMN]:
+            transcripts[column] = [label[column] for label in labels]
+        record["rows"] = len(transcripts)
+
+    if existing_df is not None:
+        transcripts = merge_videos(
+            existing_df[is_kept], transcripts, raw_transcripts_df.index
+        )
+    utils.write_df(transcripts, file_path, file_name)
+    # malformed videos too, so they aren't tried again until they change
+    utils.write_fingerprints(fingerprints, file_path, file_name)
     return transcripts
 
 
 def get_video_transcripts(channel_name, file_path, file_name, save_interval, lang):
+    # Only needed when transcripts aren't saved yet, so not imported up front
+    import request_data
+
     raw_transcripts_df = utils.open_file_or_create(
         request_data.get_transcripts,
         channel_name,
         file_path,
         file_name,
+        refresh=config.REFRESH,
         save_interval=save_interval,
         lang=lang,
     )
@@ -179,6 +555,9 @@ def get_labeled_transcripts(raw_transcripts_df, file_path, file_name):
         raw_transcripts_df,
         file_path,
         file_name,
+        refresh=config.INCREMENTAL,
+        n_workers=config.N_WORKERS,
+        chunksize=config.WORKER_CHUNKSIZE,
     )
     return labeled_transcripts_df
 
@@ -200,3 +579,4 @@ if __name__ == "__main__":
     labeled_transcripts_df = get_labeled_transcripts(
         raw_transcripts_df, config.LABELED_TRANSCRIPT_PATH, file_name
     )
+    metrics.save()
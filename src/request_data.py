@@ -1,23 +1,68 @@
 import numpy as np
 import sys
 import pandas as pd
+import requests
 
-from googleapiclient import discovery
+from functools import partial
 from pathlib import PurePath
-from youtube_transcript_api import YouTubeTranscriptApi
 
-import config, utils
+import config, metrics, utils, youtube_api
 
-YOUTUBE_API_SERVICE_NAME = "youtube"
-YOUTUBE_API_VERSION = "v3"
-YOUTUBE = discovery.build(
-    YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, developerKey=config.DEVELOPER_KEY
-)
+# Built on first use, see `get_youtube`. Set to a client of a stand-in server
+# (or any object with a `list` method) to not request from YouTube.
+YOUTUBE = None
 
 RESULTS_PER_PAGE = 50  # 1-50 as per Google's rules.
 MAX_SIZE = 5000
 
 
+
+def get_youtube():
+    # One client shared by all threads, built once something is requested
+    global YOUTUBE
+    if YOUTUBE is None:
+        if config.OFFLINE:
+            sys.exit("OFFLINE is set in config.py, not requesting from YouTube")
+        cache = None
+        if config.API_CACHE:
+            max_mb = config.API_CACHE_MAX_MB
+            cache = utils.DiskCache(
+                config.API_CACHE_PATH, max_mb * 2 ** 20 if max_mb else None
+            )
+            cache.evict()
+        YOUTUBE = youtube_api.YouTubeClient(
+            config.DEVELOPER_KEY,
+            api_url=config.YOUTUBE_API_URL,
+            cache=cache,
+            max_age=config.API_CACHE_MAX_AGE,
+            quota_limit=config.API_QUOTA_LIMIT,
+            n_connections=max(config.PLAYLIST_N_THREADS, 1),
+            n_retries=config.API_N_RETRIES,
+            backoff=config.API_RETRY_BACKOFF,
+        )
+    return YOUTUBE
+
+
+def get_transcript_api():
+    if config.OFFLINE:
+        sys.exit("OFFLINE is set in config.py, not requesting transcripts")
+    from youtube_transcript_api import YouTubeTranscriptApi
+
+    return YouTubeTranscriptApi
+
+
+def transcript_retry_exceptions():
+    # Network errors, throttling (a captcha page) and HTTP errors worth
+    # retrying, rather than a video without transcripts
+    from youtube_transcript_api import TooManyRequests, YouTubeRequestFailed
+
+    return (
+        requests.exceptions.RequestException,
+        TooManyRequests,
+        YouTubeRequestFailed,
+    )
+
+
 def look_up_resources(pages, requested_items):
     return_dict = {}
     for resource, loc in requested_items.items():
@@ -38,6 +83,15 @@ def look_up_resources(pages, requested_items):
     return return_dict
 
 
+def check_n_results(resource_pages, root_resource_id):
+    n_results = resource_pages["pageInfo"]["totalResults"]
+    if n_results > MAX_SIZE:
+        raise youtube_api.TooManyResultsError(
+            f"{root_resource_id} has {n_results} resources, more than "
+            f"MAX_SIZE={MAX_SIZE}. Edit MAX_SIZE to a higher value."
+        )
+
+
 def request_from_youtube(
     request_func,
     requested_items,
@@ -46,21 +100,33 @@ def request_from_youtube(
     file_name,
     save_interval=10,
     only_first_page=False,
+    resume=False,
+    save_final=True,
 ):
 
     i = 0
     pages = []
     next_page_token = None
+    checkpoint_df = None
+    if resume:
+        i, checkpoint_df, next_page_token = utils.load_checkpoint(file_path, file_name)
+        if next_page_token is None:  # no page to continue from
+            i, checkpoint_df = 0, None
+
+    def pages_to_df(pages):
+        resources_df = pd.DataFrame(look_up_resources(pages, requested_items))
+        if checkpoint_df is not None:
+            resources_df = pd.concat([checkpoint_df, resources_df], ignore_index=True)
+        return resources_df
+
     while True:
-        resource_pages = request_func(root_resource_id, next_page_token).execute()
+        resource_pages = request_func(root_resource_id, next_page_token)
 
         if only_first_page:
             resources = look_up_resources([resource_pages], requested_items)
             return pd.DataFrame(resources)
 
-        if resource_pages["pageInfo"]["totalResults"] > MAX_SIZE:
-            print("Too many resources. Edit MAX_SIZE to a higher value.")
-            sys.exit()
+        check_n_results(resource_pages, root_resource_id)
 
         pages.append(resource_pages)
 
@@ -69,27 +135,69 @@ def request_from_youtube(
             i += 1
 
             if i % save_interval == 0:
-                resources = look_up_resources(pages, requested_items)
-                resources_df = pd.DataFrame(resources)
+                resources_df = pages_to_df(pages)
                 utils.save_and_rem_files(
-                    resources_df, file_path, file_name, i, save_interval
+                    resources_df,
+                    file_path,
+                    file_name,
+                    i,
+                    save_interval,
+                    page_token=next_page_token,
                 )
 
         else:
-            resources = look_up_resources(pages, requested_items)
-            resources_df = pd.DataFrame(resources)
+            resources_df = pages_to_df(pages)
 
-            utils.save_and_rem_files(
-                resources_df, file_path, file_name, i, save_interval, end=True
-            )
+            if save_final:
+                utils.save_and_rem_files(
+                    resources_df, file_path, file_name, i, save_interval, end=True
+                )
+            elif i >= save_interval:
+                utils.rem_checkpoint(file_path, file_name, i - (i % save_interval))
             break
 
     return resources_df
 
 
+def playlist_request_func(channel_id, next_page_token):
+    return get_youtube().list(
+        "playlists",
+        part="id,snippet",
+        channelId=channel_id,
+        maxResults=RESULTS_PER_PAGE,
+        pageToken=next_page_token,
+        fields="nextPageToken,pageInfo,items(id),items(snippet(title))",
+    )
+
+
+REQUESTED_PLAYLIST_ITEMS = {
+    "playlist_ids": "id",
+    "playlist_titles": ["snippet", "title"],
+}
+
+
+def video_request_func(playlist_id, next_page_token):
+    return get_youtube().list(
+        "playlistItems",
+        part="snippet",
+        maxResults=RESULTS_PER_PAGE,
+        playlistId=playlist_id,
+        pageToken=next_page_token,
+        fields="nextPageToken,pageInfo,items(snippet(title)),items(snippet(resourceId(videoId)))",
+    )
+
+
+REQUESTED_VIDEO_ITEMS = {
+    "video_ids": ["snippet", "resourceId", "videoId"],
+    "video_titles": ["snippet", "title"],
+}
+
+
+@metrics.timed_stage("request_channel_ids")
 def request_channel_ids(channel_name, file_path, file_name):
     def channel_search_func(channel_name, next_page_token):
-        return YOUTUBE.search().list(
+        return get_youtube().list(
+            "search",
             part="snippet",
             q=channel_name,
             type="channel",
@@ -112,118 +220,241 @@ def request_channel_ids(channel_name, file_path, file_name):
     return channel_df
 
 
+@metrics.timed_stage("request_playlist_ids")
 def request_playlist_ids(channel_id, file_path, file_name, **kwargs):
     save_interval = kwargs["save_interval"]
+    resume = kwargs.get("resume", False)
 
-    def playlist_request_func(channel_id, next_page_token):
-        return YOUTUBE.playlists().list(
-            part="id,snippet",
-            channelId=channel_id,  #   config.CHANNEL_ID, #change to config
-            maxResults=RESULTS_PER_PAGE,
-            pageToken=next_page_token,
-            fields="nextPageToken,pageInfo,items(id),items(snippet(title))",
-        )
-
-    requested_playlist_items = {
-        "playlist_ids": "id",
-        "playlist_titles": ["snippet", "title"],
-    }
     playlist_df = request_from_youtube(
         playlist_request_func,
-        requested_playlist_items,
+        REQUESTED_PLAYLIST_ITEMS,
         channel_id,
         file_path,
         file_name,
         save_interval,
+        resume=resume,
     )
     return playlist_df
 
 
+@metrics.timed_stage("request_video_ids")
 def request_video_ids(playlist_ids, file_path, file_name, **kwargs):
     channel_id, save_interval = kwargs["channel_id"], kwargs["save_interval"]
+    resume = kwargs.get("resume", False)
+    n_threads = kwargs.get("n_threads", 1)
 
-    def video_request_func(playlist_id, next_page_token):
-        return YOUTUBE.playlistItems().list(
-            part="snippet",
-            maxResults=RESULTS_PER_PAGE,
-            playlistId=playlist_id,
-            pageToken=next_page_token,
-            fields="nextPageToken,pageInfo,items(snippet(title)),items(snippet(resourceId(videoId)))",
-        )
-
-    requested_video_items = {
-        "video_ids": ["snippet", "resourceId", "videoId"],
-        "video_titles": ["snippet", "title"],
-    }
-
-    all_videos_df = pd.DataFrame({})
+    # rows of all playlists, made into a DataFrame once all are requested
+    video_ids = []
+    video_titles = []
+    video_playlist_ids = []
 
     i = 0
-    for playlist_id in playlist_ids:
-        videos_df = request_from_youtube(
-            video_request_func, requested_video_items, playlist_id, file_path, file_name
+    if resume:
+        checkpoint_df = utils.read_checkpoint_log(file_path, file_name)
+        if checkpoint_df is not None and len(checkpoint_df) > 0:
+            # playlists are requested in order, so all up to the last saved were
+            # requested. That last one is requested again, in case its rows were
+            # cut short.
+            last_saved_id = checkpoint_df["playlist_ids"].iloc[-1]
+            if last_saved_id in playlist_ids:
+                i = playlist_ids.index(last_saved_id)
+            checkpoint_df = checkpoint_df[
+                checkpoint_df["playlist_ids"] != last_saved_id
+            ]
+            video_ids = checkpoint_df["video_ids"].tolist()
+            video_titles = checkpoint_df["video_titles"].tolist()
+            video_playlist_ids = checkpoint_df["playlist_ids"].tolist()
+    else:
+        utils.rem_checkpoint_log(file_path, file_name)
+
+    def request_playlist(playlist_id):
+        # pages of a playlist are saved separately to `file_name`, as they are
+        # only kept while that playlist is being requested
+        return request_from_youtube(
+            video_request_func,
+            REQUESTED_VIDEO_ITEMS,
+            playlist_id,
+            file_path,
+            f"{file_name}_{playlist_id}",
+            resume=resume,
+            save_final=False,
         )
-        videos_df["playlist_ids"] = [playlist_id] * len(videos_df)
-        all_videos_df = pd.concat([all_videos_df, videos_df], ignore_index=True)
+
+    # Playlists are paged concurrently, but their videos come back in the
+    # order of `playlist_ids`, so that resuming works as with one thread.
+    # Only the first time a video is listed is kept.
+    seen_ids = set(video_ids)
+    n_saved = len(video_ids)
+    playlist_videos = utils.map_in_threads(
+        request_playlist, playlist_ids[i:], n_threads
+    )
+    for playlist_id, videos_df in zip(playlist_ids[i:], playlist_videos):
+        for video_id, video_title in zip(
+            videos_df.get("video_ids", []), videos_df.get("video_titles", [])
+        ):
+            if video_id not in seen_ids:
+                seen_ids.add(video_id)
+                video_ids.append(video_id)
+                video_titles.append(video_title)
+                video_playlist_ids.append(playlist_id)
 
         i += 1
 
         if i % save_interval == 0:
-            utils.save_and_rem_files(
-                all_videos_df, file_path, file_name, i, save_interval
+            utils.append_to_checkpoint_log(
+                pd.DataFrame(
+                    {
+                        "video_ids": video_ids[n_saved:],
+                        "video_titles": video_titles[n_saved:],
+                        "playlist_ids": video_playlist_ids[n_saved:],
+                    }
+                ),
+                file_path,
+                file_name,
             )
+            n_saved = len(video_ids)
 
-    all_videos_df.set_index("video_ids", inplace=True)
-    all_videos_df = all_videos_df[~all_videos_df.index.duplicated(keep="first")]
+    all_videos_df = pd.DataFrame(
+        {"video_titles": video_titles, "playlist_ids": video_playlist_ids},
+        index=pd.Index(video_ids, name="video_ids"),
+    )
     all_videos_df["channel_ids"] = [channel_id] * len(all_videos_df)
 
-    utils.save_and_rem_files(
-        all_videos_df, file_path, file_name, i, save_interval, end=True
-    )
+    utils.save_and_rem_files(all_videos_df, file_path, file_name, end=True)
+    utils.rem_checkpoint_log(file_path, file_name)
 
     return all_videos_df
 
 
+def fetch_transcript(
+    video_id, lang, transcript_api, rate_limiter=None, n_retries=0, backoff=1.0
+):
+    # Returns None for a video without both transcripts. Requests still failing
+    # after the retries raise, so that the video isn't saved as one without.
+    retry_on = transcript_retry_exceptions()
+    retry = partial(
+        utils.call_with_retries,
+        n_retries=n_retries,
+        backoff=backoff,
+        retry_on=retry_on,
+        rate_limiter=rate_limiter,
+    )
+    try:
+        transcript_list = retry(transcript_api.list_transcripts, video_id)
+        transcript_auto = transcript_list.find_generated_transcript([lang])
+        transcript_manual = transcript_list.find_manually_created_transcript([lang])
+        autogen = retry(transcript_auto.fetch)
+        manual = retry(transcript_manual.fetch)
+    except ValueError:
+        if config.PRINT_TRANSCRIPT_API_ERR:
+            print("Transcript not found, and/or:", sys.exc_info()[0])
+        return None
+    except KeyboardInterrupt:
+        raise KeyboardInterrupt
+    except retry_on:
+        raise
+    except Exception:
+        if config.PRINT_TRANSCRIPT_API_ERR:
+            print("Unexpected error:", sys.exc_info()[0])
+        return None
+
+    return autogen, manual
+
+
+def fetch_transcripts(video_ids, lang, transcript_api, n_threads=1, **fetch_kwargs):
+    # Yields (video_id, autogen, manual) in the order of `video_ids`, skipping
+    # videos without both transcripts, while up to `n_threads` are in flight.
+    fetch = partial(
+        fetch_transcript, lang=lang, transcript_api=transcript_api, **fetch_kwargs
+    )
+    results = utils.map_in_threads(fetch, video_ids, n_threads)
+    try:
+        for video_id, transcripts in zip(video_ids, results):
+            if transcripts is not None:
+                yield (video_id, *transcripts)
+    finally:
+        results.close()
+
+
+@metrics.timed_stage("request_raw_transcript")
 def request_raw_transcript(videos_df, file_path, file_name, **kwargs):
     save_interval = kwargs["save_interval"]
     lang = kwargs["lang"]
+    transcript_api = kwargs.get("transcript_api") or get_transcript_api()
+    requests_per_sec = kwargs.get("requests_per_sec", None)
+    resume = kwargs.get("resume", False)
+    existing_df = kwargs.get("existing_df", None)
+
+    rate_limiter = None
+    if requests_per_sec:
+        rate_limiter = utils.RateLimiter(requests_per_sec, burst=requests_per_sec)
 
     autogen = []
     manual = []
     passing_video_ids = []
 
     video_ids = videos_df.index.tolist()
+    if existing_df is not None:  # refreshing, so only request new videos
+        existing_ids = set(existing_df.index)
+        video_ids = [video_id for video_id in video_ids if video_id not in existing_ids]
 
     i = 0
-    for video_id in video_ids:
-        try:
-            transcript_list = YouTubeTranscriptApi.list_transcripts(video_id)
-            transcript_auto = transcript_list.find_generated_transcript([lang])
-            transcript_manual = transcript_list.find_manually_created_transcript([lang])
-        except ValueError:
-            if config.PRINT_TRANSCRIPT_API_ERR:
-                print("Transcript not found, and/or:", sys.exc_info()[0])
-            continue
-        except KeyboardInterrupt:
-            raise KeyboardInterrupt
-        except Exception:
-            if config.PRINT_TRANSCRIPT_API_ERR:
-                print("Unexpected error:", sys.exc_info()[0])
-            continue
-
-        autogen.append(transcript_auto.fetch())
-        manual.append(transcript_manual.fetch())
-        passing_video_ids.append((video_id))
+    if resume:
+        checkpoint_df = utils.read_checkpoint_log(file_path, file_name)
+        if checkpoint_df is not None and len(checkpoint_df) > 0:
+            i = len(checkpoint_df)
+            passing_video_ids = checkpoint_df["video_ids"].tolist()
+            autogen = checkpoint_df["autogen"].tolist()
+            manual = checkpoint_df["manual"].tolist()
+            # videos are requested in order, so all up to the last saved were tried
+            last_saved_id = passing_video_ids[-1]
+            if last_saved_id in video_ids:
+                video_ids = video_ids[video_ids.index(last_saved_id) + 1 :]
+            else:
+                saved_ids = set(passing_video_ids)
+                video_ids = [
+                    video_id for video_id in video_ids if video_id not in saved_ids
+                ]
+    else:
+        utils.rem_checkpoint_log(file_path, file_name)
+
+    n_saved = i
+
+    def save_checkpoint():
+        nonlocal n_saved
+        new_transcripts_df = pd.DataFrame(
+            {
+                "video_ids": passing_video_ids[n_saved:],
+                "autogen": autogen[n_saved:],
+                "manual": manual[n_saved:],
+            }
+        )
+        utils.append_to_checkpoint_log(new_transcripts_df, file_path, file_name)
+        n_saved = i
+
+    try:
+        for video_id, transcript_auto, transcript_manual in fetch_transcripts(
+            video_ids,
+            lang,
+            transcript_api,
+            n_threads=kwargs.get("n_threads", 1),
+            rate_limiter=rate_limiter,
+            n_retries=kwargs.get("n_retries", 0),
+            backoff=kwargs.get("backoff", 1.0),
+        ):
+            autogen.append(transcript_auto)
+            manual.append(transcript_manual)
+            passing_video_ids.append((video_id))
 
-        i += 1
+            i += 1
 
-        if (i % save_interval == 0) and i > 0:
-            intermediate_transcripts_df = pd.DataFrame(
-                {"video_ids": passing_video_ids, "autogen": autogen, "manual": manual}
-            )
-            utils.save_and_rem_files(
-                intermediate_transcripts_df, file_path, file_name, i, save_interval
-            )
+            if (i % save_interval == 0) and i > 0:
+                save_checkpoint()
+    except BaseException:
+        # videos come in order, so resuming starts at the one that failed
+        if i > n_saved:
+            save_checkpoint()
+        raise
 
     raw_transcripts_df = pd.DataFrame(
         {"video_ids": passing_video_ids, "autogen": autogen, "manual": manual}
@@ -232,10 +463,11 @@ def request_raw_transcript(videos_df, file_path, file_name, **kwargs):
     raw_video_transcripts_df = videos_df.join(
         raw_transcripts_df.set_index("video_ids"), how="inner"
     )
+    if existing_df is not None:
+        raw_video_transcripts_df = pd.concat([existing_df, raw_video_transcripts_df])
 
-    utils.save_and_rem_files(
-        raw_video_transcripts_df, file_path, file_name, i, save_interval, end=True
-    )
+    utils.save_and_rem_files(raw_video_transcripts_df, file_path, file_name, end=True)
+    utils.rem_checkpoint_log(file_path, file_name)
 
     return raw_video_transcripts_df
 
@@ -250,47 +482,65 @@ def get_channel_ids(channel_name, file_path, file_name):
     return channels
 
 
-def get_playlist_ids(channel_id, file_path, file_name, save_interval):
+def get_playlist_ids(
+    channel_id, file_path, file_name, save_interval, refresh=False, resume=False
+):
     playlists = utils.open_file_or_create(
         request_playlist_ids,
         channel_id,
         file_path,
         file_name,
+        refresh=refresh,
         save_interval=save_interval,
+        resume=resume,
     )
     return playlists
 
 
-def get_video_ids(playlist_ids, file_path, file_name, channel_id, save_interval):
+def get_video_ids(
+    playlist_ids,
+    file_path,
+    file_name,
+    channel_id,
+    save_interval,
+    refresh=False,
+    resume=False,
+):
     video_ids = utils.open_file_or_create(
         request_video_ids,
         playlist_ids,
         file_path,
         file_name,
+        refresh=refresh,
         channel_id=channel_id,
         save_interval=save_interval,
+        resume=resume,
+        n_threads=config.PLAYLIST_N_THREADS,
     )
     return video_ids
 
 
-def get_raw_transcripts(video_ids, file_path, file_name, save_interval, lang):
+def get_raw_transcripts(
+    video_ids, file_path, file_name, save_interval, lang, refresh=False, resume=False
+):
     transcripts = utils.open_file_or_create(
         request_raw_transcript,
         video_ids,
         file_path,
         file_name,
+        refresh=refresh,
+        resume=resume,
         save_interval=save_interval,
         lang=lang,
+        n_threads=config.TRANSCRIPT_N_THREADS,
+        requests_per_sec=config.TRANSCRIPT_REQUESTS_PER_SEC,
+        n_retries=config.TRANSCRIPT_N_RETRIES,
+        backoff=config.TRANSCRIPT_RETRY_BACKOFF,
     )
     return transcripts
 
 
-def get_transcripts(channel_name, file_path, file_name, save_interval, lang):
-
-    channel_ids_df = get_channel_ids(channel_name, config.CHANNEL_PATH, file_name)
-    if config.GET_CHANNEL_IDS_ONLY:
-        return
-    channel_id = channel_ids_df["channel_ids"].tolist()[0]
+def confirm_channel(channel_id, file_name):
     full_filename = str(PurePath(config.CHANNEL_PATH, f"{file_name}.json"))
     input(
         f"""
@@ -303,18 +553,47 @@ def get_transcripts(channel_name, file_path, file_name, save_interval, lang):
         """
     )
 
+
+def get_channel_videos(channel_name, file_name, save_interval):
+    # Videos of the channel once confirmed, or None if stopping at its ids
+    channel_ids_df = get_channel_ids(channel_name, config.CHANNEL_PATH, file_name)
+    if config.GET_CHANNEL_IDS_ONLY:
+        return
+    channel_id = channel_ids_df["channel_ids"].tolist()[0]
+    confirm_channel(channel_id, file_name)
+
     playlist_ids_df = get_playlist_ids(
-        channel_id, config.PLAYLIST_PATH, file_name, save_interval
+        channel_id,
+        config.PLAYLIST_PATH,
+        file_name,
+        save_interval,
+        refresh=config.REFRESH,
+        resume=config.RESUME,
     )
     if config.GET_PLAYLIST_IDS_ONLY:
         return
-    playlist_ids = list(set(playlist_ids_df["playlist_ids"].tolist()))
+    # deduplicated in a stable order, so a resumed request skips the same playlists
+    playlist_ids = list(dict.fromkeys(playlist_ids_df["playlist_ids"].tolist()))
 
     videos_df = get_video_ids(
-        playlist_ids, config.VIDEO_PATH, file_name, channel_id, save_interval
+        playlist_ids,
+        config.VIDEO_PATH,
+        file_name,
+        channel_id,
+        save_interval,
+        refresh=config.REFRESH,
+        resume=config.RESUME,
     )
     if config.GET_VIDEO_IDS_ONLY:
         return
+    return videos_df
+
+
+def get_transcripts(channel_name, file_path, file_name, save_interval, lang, **kwargs):
+
+    videos_df = get_channel_videos(channel_name, file_name, save_interval)
+    if videos_df is None:
+        return
 
     raw_transcripts_df = get_raw_transcripts(
         videos_df,
@@ -322,6 +601,8 @@ def get_transcripts(channel_name, file_path, file_name, save_interval, lang):
         file_name,
         config.TRANSCRIPT_SAVE_INTERVAL,
         lang,
+        refresh=config.REFRESH,
+        resume=config.RESUME,
     )
     if len(raw_transcripts_df.video_titles) == 0:
         sys.exit("No manually generated transcripts on this channel")
@@ -335,6 +616,13 @@ if __name__ == "__main__":
     channel_name = config.CHANNEL_NAME
     file_name = "_".join(channel_name.split())
 
-    raw_transcripts = get_transcripts(
-        channel_name, file_path, file_name, config.SAVE_INTERVAL, lang
-    )
+    try:
+        raw_transcripts = get_transcripts(
+            channel_name, file_path, file_name, config.SAVE_INTERVAL, lang
+        )
+    except youtube_api.YouTubeApiError as e:
+        sys.exit(str(e))
+    finally:
+        metrics.save()
+    if YOUTUBE is not None:
+        print(f"YouTube API quota units spent: {dict(YOUTUBE.quota_used)}")
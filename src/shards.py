@@ -0,0 +1,164 @@
+import json
+import numpy as np
+
+from pathlib import Path, PurePath
+
+import config
+import metrics
+import utils
+from compact import load_vocabulary, save_vocabulary
+from prepare_data import TIMING_COLUMN
+
+# Split postproc transcripts as shards of flat arrays, memory mapped when read,
+# where an example is the same slice of each array:
+#   <name>_<i>/offsets.npy         example j is [offsets[j], offsets[j + 1])
+#   <name>_<i>/default_ids.npy     token ids of all examples, one after another
+#   <name>_<i>/correction_ids.npy
+#   <name>_<i>/diff_type.npy
+#   <name>_<i>/token_starts.npy    if every example of the shard has timings
+#   <name>_<i>/meta.json           video ids, titles, playlist and channel ids
+# with token ids into vocabulary.json, and the shards listed in shards.json.
+
+SHARD_ARRAYS = {
+    "default_ids": np.int32,
+    "correction_ids": np.int32,
+    "diff_type": np.int8,
+    TIMING_COLUMN: np.float32,
+}
+META_COLUMNS = ["video_ids", "video_titles", "playlist_ids", "channel_ids"]
+
+
+def write_shard(examples, shard_path):
+    Path(shard_path).mkdir(parents=True, exist_ok=True)
+    offsets = np.zeros(len(examples) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(example["diff_type"]) for example in examples])
+    np.save(str(PurePath(shard_path, "offsets.npy")), offsets)
+
+    for name, dtype in SHARD_ARRAYS.items():
+        sequences = [example.get(name) for example in examples]
+        # postproc files saved before timings were kept have none, or NaN
+        if not all(isinstance(seq, (list, np.ndarray)) for seq in sequences):
+            continue
+        array = np.concatenate(
+            [np.asarray(seq, dtype=dtype) for seq in sequences]
+            or [np.zeros(0, dtype=dtype)]
+        )
+        np.save(str(PurePath(shard_path, f"{name}.npy")), array)
+
+    with open(PurePath(shard_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                column: [example.get(column) for example in examples]
+                for column in META_COLUMNS
+            },
+            f,
+        )
+
+
+@metrics.timed_stage("split_files_to_shards")
+def split_files_to_shards(reading_path, writing_path, writing_filename, n_lines):
+    # Same examples and splits as `split_files_by_lines`, written as shards.
+    # Only about one file and one shard are held in memory.
+    suffix = utils.STORAGE_SUFFIXES[config.STORAGE_FORMAT]
+    all_names = sorted(f.stem for f in Path(reading_path).glob(f"*{suffix}"))
+    Path(writing_path).mkdir(parents=True, exist_ok=True)
+
+    token_ids = {"": 0}
+
+    def to_ids(tokens):
+        return [token_ids.setdefault(token, len(token_ids)) for token in tokens]
+
+    shards = []
+
+    def write_split(examples):
+        name = f"{writing_filename}_{len(shards)}"
+        write_shard(examples, PurePath(writing_path, name))
+        shards.append({"name": name, "n_examples": len(examples)})
+
+    seen_video_ids = set()
+    examples = []
+    for f_name in all_names:
+        df = utils.read_df(reading_path, f_name)
+        if "video_ids" not in df:
+            df = df.rename_axis("video_ids").reset_index()
+
+        for t in df.to_dict("records"):
+            if t["video_ids"] in seen_video_ids:
+                continue
+            seen_video_ids.add(t["video_ids"])
+            t["default_ids"] = to_ids(t.pop("default_seq"))
+            t["correction_ids"] = to_ids(t.pop("correction_seq"))
+            examples.append(t)
+
+            if len(examples) == n_lines:
+                write_split(examples)
+                examples = []
+        metrics.inc("rows_total", len(df), stage="split_files_to_shards")
+
+    if examples:
+        write_split(examples)
+
+    # written last, so readers never see shards with ids missing from it
+    save_vocabulary(list(token_ids), PurePath(writing_path, "vocabulary.json"))
+    with open(PurePath(writing_path, "shards.json"), "w") as f:
+        json.dump({"shards": shards}, f)
+    print(f"saved {len(seen_video_ids)} examples in {len(shards)} shards")
+
+
+class ShardReader:
+    """Examples of the shards saved by `split_files_to_shards` in `shard_path`,
+    indexed over all shards. The arrays of an example are views into the
+    memory mapped shards, so opening is instant, nothing is read until used,
+    and processes reading the same shards share their pages."""
+
+    def __init__(self, shard_path):
+        with open(PurePath(shard_path, "shards.json")) as f:
+            shards = json.load(f)["shards"]
+        self.vocabulary = load_vocabulary(PurePath(shard_path, "vocabulary.json"))
+
+        self.arrays = []
+        self.metas = []
+        for shard in shards:
+            path = PurePath(shard_path, shard["name"])
+            self.arrays.append(
+                {
+                    name: np.load(str(PurePath(path, f"{name}.npy")), mmap_mode="r")
+                    for name in ["offsets", *SHARD_ARRAYS]
+                    if Path(path, f"{name}.npy").exists()
+                }
+            )
+            with open(PurePath(path, "meta.json")) as f:
+                self.metas.append(json.load(f))
+        self.starts = np.cumsum([0] + [shard["n_examples"] for shard in shards])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"example {i} of {len(self)}")
+        shard = int(np.searchsorted(self.starts, i, side="right")) - 1
+        j = i - int(self.starts[shard])
+
+        arrays = self.arrays[shard]
+        s = slice(int(arrays["offsets"][j]), int(arrays["offsets"][j + 1]))
+        example = {column: values[j] for column, values in self.metas[shard].items()}
+        example.update(
+            {name: array[s] for name, array in arrays.items() if name != "offsets"}
+        )
+        return example
+
+    def tokens(self, ids):
+        return [self.vocabulary[i] for i in ids]
+
+
+if __name__ == "__main__":
+    split_files_to_shards(
+        config.POSTPROC_TRANSCRIPT_PATH,
+        config.SHARD_PATH,
+        config.SPLIT_LABELED_FILENAME,
+        config.SPLIT_FILE_N_LINES,
+    )
+    metrics.save()
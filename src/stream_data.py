@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from pathlib import Path, PurePath
+
+import config
+import metrics
+import utils
+import prepare_data
+import postprocess_data
+
+# Videos go from raw transcripts to postproc records one at a time, through a
+# chain of generator stages, and each record is written as a line of JSON as
+# soon as it is done. So only about one video is held in memory, rather than a
+# DataFrame of the whole channel per stage, and the first records of a channel
+# are out as soon as its first transcripts are.
+
+STREAM_SUFFIX = ".jsonl"
+META_COLUMNS = ["video_titles", "playlist_ids", "channel_ids"]
+RAW_COLUMNS = ["video_ids"] + META_COLUMNS + ["autogen", "manual"]
+POSTPROC_COLUMNS = [
+    "video_ids",
+    *META_COLUMNS,
+    "diff_type",
+    "default_seq",
+    "correction_seq",
+    prepare_data.TIMING_COLUMN,
+]
+PROGRESS_INTERVAL = 50  # videos
+
+
+def jsonl_path(file_path, file_name):
+    return PurePath(file_path, f"{file_name}{STREAM_SUFFIX}")
+
+
+def to_json(value):
+    # numpy values of the records, e.g. the float32 token_starts
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def write_jsonl(videos, file_path, file_name, columns=None):
+    # Writes `columns` of each video as it passes through to the next stage,
+    # flushed so the .tmp file can be read while the channel is still
+    # streaming. It is renamed only once all videos are through, so a stopped
+    # stream never leaves a file that looks like the whole channel.
+    Path(file_path).mkdir(parents=True, exist_ok=True)
+    path = Path(jsonl_path(file_path, file_name))
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        for video in videos:
+            if columns is not None:
+                record = {
+                    column: video[column] for column in columns if column in video
+                }
+            else:
+                record = video
+            f.write(json.dumps(record, default=to_json) + "\n")
+            f.flush()
+            yield video
+    os.replace(tmp_path, path)
+
+
+def read_jsonl(file_path, file_name):
+    with open(jsonl_path(file_path, file_name)) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def saved_raw_transcripts(file_path, file_name):
+    # Videos of a saved raw transcripts file. The file is read whole, but its
+    # videos are still passed on one at a time.
+    df = utils.read_df(file_path, file_name)
+    for row in df.itertuples():
+        video = row._asdict()
+        video["video_ids"] = video.pop("Index")
+        yield video
+
+
+def requested_raw_transcripts(channel_name, file_name, lang):
+    # Videos of a channel as soon as their transcripts are fetched
+    import request_data
+
+    videos_df = request_data.get_channel_videos(
+        channel_name, file_name, config.SAVE_INTERVAL
+    )
+    if videos_df is None:
+        return
+
+    rate_limiter = None
+    if config.TRANSCRIPT_REQUESTS_PER_SEC:
+        rate_limiter = utils.RateLimiter(
+            config.TRANSCRIPT_REQUESTS_PER_SEC,
+            burst=config.TRANSCRIPT_REQUESTS_PER_SEC,
+        )
+    for video_id, autogen, manual in request_data.fetch_transcripts(
+        videos_df.index.tolist(),
+        lang,
+        request_data.get_transcript_api(),
+        n_threads=config.TRANSCRIPT_N_THREADS,
+        rate_limiter=rate_limiter,
+        n_retries=config.TRANSCRIPT_N_RETRIES,
+        backoff=config.TRANSCRIPT_RETRY_BACKOFF,
+    ):
+        video = videos_df.loc[video_id, META_COLUMNS].to_dict()
+        video.update({"video_ids": video_id, "autogen": autogen, "manual": manual})
+        yield video
+
+
+def extract_texts(videos):
+    for video in videos:
+        video["autogen_text"] = prepare_data.extract_text(video["autogen"])
+        video["manual_text"] = prepare_data.extract_text(video["manual"])
+        if "extract_text_error" in (video["autogen_text"], video["manual_text"]):
+            metrics.inc("malformed_videos_total", stage="stream")
+            continue
+        video["autogen_starts"] = prepare_data.extract_token_starts(video["autogen"])
+        yield video
+
+
+def label_videos(videos, diff_cache=None):
+    # `prepare_data.diff_and_label` of each video, reusing cached diffs
+    for video in videos:
+        texts = {
+            "autogen_text": video["autogen_text"],
+            "manual_text": video["manual_text"],
+            "autogen_starts": video.pop("autogen_starts"),
+        }
+        if diff_cache is None:
+            label = prepare_data.diff_and_label(texts)
+        else:
+            key = prepare_data.diff_cache_key(texts)
+            diffs = diff_cache.get(key)
+            if diffs is None:
+                label = prepare_data.diff_and_label(texts)
+                diff_cache.put(key, label["diffs"])
+            else:
+                label = prepare_data.label_diff_targets(
+                    {"diffs": diffs}, texts["autogen_starts"]
+                )
+        video.update(label)
+        yield video
+
+
+def postprocess_videos(videos, token_caches):
+    for video in videos:
+        # as a Series, for the attribute access of the postprocess functions
+        t = postprocess_data.add_simple_single_token_diff_labels(
+            pd.Series(video), token_caches
+        )
+        yield t.to_dict()
+
+
+def stream_channel(channel_name, lang, tee=()):
+    # Streams a channel to POSTPROC_TRANSCRIPT_PATH/<file_name>.jsonl, from its
+    # raw transcripts (saved as .jsonl or as usual, else requested). "raw" and
+    # "labeled" in `tee` also write those stages to their usual paths as .jsonl.
+    file_name = "_".join(channel_name.split())
+    raw_path = config.RAW_TRANSCRIPT_PATH
+
+    if Path(jsonl_path(raw_path, file_name)).exists():
+        videos = read_jsonl(raw_path, file_name)
+    elif Path(utils.data_file_path(raw_path, file_name)).exists():
+        videos = saved_raw_transcripts(raw_path, file_name)
+    else:
+        videos = requested_raw_transcripts(channel_name, file_name, lang)
+        if "raw" in tee:
+            videos = write_jsonl(videos, raw_path, file_name, RAW_COLUMNS)
+
+    diff_cache = prepare_data.get_diff_cache()
+    token_caches = postprocess_data.get_token_caches()
+    videos = label_videos(extract_texts(videos), diff_cache)
+    if "labeled" in tee:
+        videos = write_jsonl(videos, config.LABELED_TRANSCRIPT_PATH, file_name)
+    videos = postprocess_videos(videos, token_caches)
+    columns = POSTPROC_COLUMNS if config.USE_ONLY_POSTPROC_LABELS else None
+    videos = write_jsonl(videos, config.POSTPROC_TRANSCRIPT_PATH, file_name, columns)
+
+    with metrics.stage("stream_channel") as record:
+        start = time.perf_counter()
+        n_videos = 0
+        for _ in videos:
+            n_videos += 1
+            if n_videos == 1:
+                print(f"first record after {time.perf_counter() - start:.1f}s")
+            elif n_videos % PROGRESS_INTERVAL == 0:
+                print(f"{n_videos} videos in {time.perf_counter() - start:.1f}s")
+        record["rows"] = n_videos
+
+    if diff_cache is not None:
+        diff_cache.evict()
+    if config.PERSIST_TOKEN_CACHE:
+        postprocess_data.save_token_caches(token_caches, config.TOKEN_CACHE_PATH)
+    print(f"saved {n_videos} videos to {config.POSTPROC_TRANSCRIPT_PATH}")
+    return n_videos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-c",
+        "--channel",
+        default=config.CHANNEL_NAME,
+        help="YouTube channel name",
+    )
+    parser.add_argument(
+        "--tee",
+        nargs="*",
+        choices=["raw", "labeled"],
+        default=[],
+        help="also write these stages as JSON Lines",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        stream_channel(args.channel, config.LANGUAGE, args.tee)
+    except KeyboardInterrupt:
+        sys.exit("stopped, records streamed so far are in the .tmp files")
+    finally:
+        metrics.save()
@@ -1,67 +1,442 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from pathlib import PurePath, Path
 
 import config
+import metrics
 
+STORAGE_SUFFIXES = {"json": ".json", "parquet": ".parquet"}
+# Lists mixing str and dict can't be a Parquet column, so are kept as JSON text
+JSON_ENCODED_COLUMNS = ["diffs"]
 
-def open_file_or_create(gen_data_func, root_resource, file_path, file_name, **kwargs):
+
+def data_file_path(file_path, file_name, storage_format=None):
+    storage_format = storage_format or config.STORAGE_FORMAT
+    return PurePath(file_path, f"{file_name}{STORAGE_SUFFIXES[storage_format]}")
+
+
+@metrics.timed_stage("read_df")
+def read_df(file_path, file_name, storage_format=None, columns=None):
+    storage_format = storage_format or config.STORAGE_FORMAT
+    full_path = str(data_file_path(file_path, file_name, storage_format))
+
+    if storage_format == "parquet":
+        df = pd.read_parquet(full_path, columns=columns)
+        # list columns are read as numpy arrays, and kept as arrays rather
+        # than copied back into lists on every read
+        for column in df.columns:
+            if column in JSON_ENCODED_COLUMNS:
+                df[column] = df[column].map(json.loads)
+        return df
+
+    df = pd.read_json(full_path)
+    return df if columns is None else df[columns]
+
+
+def write_df(df, file_path, file_name, storage_format=None, orient=None):
+    storage_format = storage_format or config.STORAGE_FORMAT
+    full_path = str(data_file_path(file_path, file_name, storage_format))
+
+    with metrics.stage("write_df") as record:
+        if storage_format == "parquet":
+            json_columns = [column for column in JSON_ENCODED_COLUMNS if column in df]
+            df = df.assign(
+                **{column: df[column].map(json.dumps) for column in json_columns}
+            )
+            df.to_parquet(full_path)
+        else:
+            df.to_json(full_path, orient=orient)
+        record["rows"] = len(df)
+        record["bytes_written"] = os.path.getsize(full_path)
+
+
+def open_file_or_create(
+    gen_data_func, root_resource, file_path, file_name, refresh=False, **kwargs
+):
 
     try:  # to get already requested and saved data
-        full_path = str(PurePath(file_path, f"{file_name}.json"))
-        data_df = pd.read_json(full_path)
+        full_path = str(data_file_path(file_path, file_name))
+        data_df = read_df(file_path, file_name)
         print(f"reading {full_path}")
 
-    except ValueError:
+    except (ValueError, FileNotFoundError):
         Path(file_path).mkdir(parents=True, exist_ok=True)
         print(f"requesting data for {full_path}")
         data_df = gen_data_func(root_resource, file_path, file_name, **kwargs)
 
+    else:
+        if refresh:  # only request what is missing from the saved data
+            print(f"refreshing {full_path}")
+            data_df = gen_data_func(
+                root_resource, file_path, file_name, existing_df=data_df, **kwargs
+            )
+
     return data_df
 
 
-def save_and_rem_files(df, file_path, file_name, i=0, save_interval=100, end=False):
-    if end:
-        full_path = str(PurePath(file_path, f"{file_name}.json"))
+def checkpoint_path(file_path, file_name, i, suffix=".json"):
+    return Path(file_path, f"i{i}_{file_name}{suffix}")
 
-        df.to_json(full_path)
 
-        if i > save_interval:
-            file_to_rem = Path(
-                file_path, f"i{i - (i % save_interval)}_{file_name}.json"
-            )
-            file_to_rem.unlink()
+def rem_checkpoint(file_path, file_name, i):
+    checkpoint_path(file_path, file_name, i).unlink(missing_ok=True)
+    checkpoint_path(file_path, file_name, i, ".page_token").unlink(missing_ok=True)
+
+
+def save_and_rem_files(
+    df, file_path, file_name, i=0, save_interval=100, end=False, page_token=None
+):
+    if end:
+        write_df(df, file_path, file_name)
+
+        if i >= save_interval:
+            rem_checkpoint(file_path, file_name, i - (i % save_interval))
     else:
-        df.to_json(str(PurePath(file_path, f"i{i}_{file_name}.json")))
+        with metrics.stage("checkpoint") as record:
+            full_path = checkpoint_path(file_path, file_name, i)
+            df.to_json(str(full_path))
+            record["rows"] = len(df)
+            record["bytes_written"] = full_path.stat().st_size
+        if page_token is not None:
+            checkpoint_path(file_path, file_name, i, ".page_token").write_text(
+                page_token
+            )
         if i > save_interval:
-            file_to_rem = Path(file_path, f"i{i - save_interval}_{file_name}.json")
-            file_to_rem.unlink()
+            rem_checkpoint(file_path, file_name, i - save_interval)
 
 
-def split_files_by_lines(reading_path, writing_path, writing_filename, n_lines):
-    path = Path(reading_path)
-    print(f"reading from {reading_path}")
+def load_checkpoint(file_path, file_name):
+    # Latest intermediate save of `save_and_rem_files` as (i, df, page_token)
+    path = Path(file_path)
+    if not path.is_dir():
+        return 0, None, None
+
+    pattern = re.compile(rf"i(\d+)_{re.escape(file_name)}\.json")
+    saved_i = []
+    for f in path.iterdir():
+        match = pattern.fullmatch(f.name)
+        if match:
+            saved_i.append(int(match.group(1)))
+    if not saved_i:
+        return 0, None, None
+
+    i = max(saved_i)
+    print(f"resuming from {checkpoint_path(file_path, file_name, i)}")
+    df = pd.read_json(str(checkpoint_path(file_path, file_name, i)))
+
+    page_token_path = checkpoint_path(file_path, file_name, i, ".page_token")
+    page_token = page_token_path.read_text() if page_token_path.exists() else None
+
+    return i, df, page_token
+
+
+def checkpoint_log_path(file_path, file_name):
+    return Path(file_path, f"{file_name}.checkpoint.jsonl")
+
+
+def append_to_checkpoint_log(df, file_path, file_name):
+    # Only the rows added since the last save are written, one JSON record per
+    # line, and synced to disk before the crawl moves on.
+    if len(df) == 0:
+        return
+    lines = df.to_json(orient="records", lines=True)
+    if not lines.endswith("\n"):
+        lines += "\n"
+    with metrics.stage("checkpoint") as record:
+        with open(checkpoint_log_path(file_path, file_name), "a") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        record["rows"] = len(df)
+        record["bytes_written"] = len(lines.encode())
+
+
+def read_checkpoint_log(file_path, file_name):
+    # Rows saved by `append_to_checkpoint_log`, or None if there is no log. A
+    # last line cut short by a crash is dropped, and truncated from the log so
+    # that further appends start on a fresh line.
+    path = checkpoint_log_path(file_path, file_name)
+    if not path.exists():
+        return None
+
+    print(f"resuming from {path}")
+    rows = []
+    valid_size = 0
+    with open(path, "rb+") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                break
+            valid_size += len(line)
+        f.truncate(valid_size)
+
+    return pd.DataFrame(rows)
+
+
+def rem_checkpoint_log(file_path, file_name):
+    checkpoint_log_path(file_path, file_name).unlink(missing_ok=True)
+
+
+def fingerprints_path(file_path, file_name):
+    # not `.json`, so it isn't taken for a data file
+    return Path(file_path, f"{file_name}.fingerprints")
 
-    all_names = [
-        f.name for f in path.iterdir() if f.is_file() and f.suffix.lower() == ".json"
-    ]
-    all_dfs = [pd.read_json(str(PurePath(path, f_name))) for f_name in all_names]
 
-    df = pd.concat(all_dfs, ignore_index=True)
+def read_fingerprints(file_path, file_name):
+    # {video_id: fingerprint} saved along with a data file, {} if there are none
+    try:
+        with open(fingerprints_path(file_path, file_name)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
 
-    dups = df[df.index.duplicated()].index
-    df.drop(dups, inplace=True)
 
-    len_df = len(df)
-    chunks = list(range(0, len_df + 1, n_lines))
-    if chunks[-1] != len_df:
-        chunks.append(len_df)
+def write_fingerprints(fingerprints, file_path, file_name):
+    with open(fingerprints_path(file_path, file_name), "w") as f:
+        json.dump(fingerprints, f)
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` calls per second, in bursts of up to `burst`
+    (at least 1, so that rates below 1 call per second still get a call).
+    Safe to share between threads."""
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError(f"rate must be above 0 calls per second, not {rate}")
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last_refill) * self.rate
+                )
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class LRUCache:
+    """Memoizes the one argument `func`, keeping the `max_size` most recently
+    used results (all of them if None), and counting hits and misses."""
+
+    def __init__(self, func, max_size=None):
+        self.func = func
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key):
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            value = self.cache[key] = self.func(key)
+            if self.max_size is not None and len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return value
+
+    def __len__(self):
+        return len(self.cache)
+
+    def hit_rate(self):
+        n_calls = self.hits + self.misses
+        return self.hits / n_calls if n_calls else 0.0
+
+    def items(self):  # least recently used first
+        return list(self.cache.items())
+
+    def load(self, items):
+        for key, value in items:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+        while self.max_size is not None and len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+
+class DiskCache:
+    """Json values saved one file per key under `file_path`. Keys are hashes of
+    their content, so entries never go stale. Once over `max_bytes`, the least
+    recently used entries are removed by `evict`."""
+
+    def __init__(self, file_path, max_bytes=None):
+        self.path = Path(file_path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return self.path / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path) as f:
+                value = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(entry_path)  # mtime is the last use, for eviction
+        return value
+
+    def put(self, key, value):
+        entry_path = self.entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        # written whole then renamed, so readers never see part of an entry
+        tmp_path = entry_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, entry_path)
+
+    def hit_rate(self):
+        n_calls = self.hits + self.misses
+        return self.hits / n_calls if n_calls else 0.0
+
+    def entries(self):  # least recently used first
+        stats = [(f.stat(), f) for f in self.path.glob("*/*.json")]
+        return [
+            (f, stat.st_size) for stat, f in sorted(stats, key=lambda s: s[0].st_mtime)
+        ]
+
+    def evict(self):
+        if self.max_bytes is None:
+            return 0
+        entries = self.entries()
+        n_bytes = sum(size for _, size in entries)
+        n_evicted = 0
+        for f, size in entries:
+            if n_bytes <= self.max_bytes:
+                break
+            f.unlink(missing_ok=True)
+            n_bytes -= size
+            n_evicted += 1
+        return n_evicted
+
+
+def call_with_retries(
+    func, *args, n_retries=0, backoff=1.0, retry_on=(), rate_limiter=None
+):
+    # Exponential backoff: waits `backoff`, 2 * `backoff`, 4 * `backoff`...
+    for attempt in range(n_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        metrics.inc("api_calls_total", method=func.__name__)
+        try:
+            return func(*args)
+        except retry_on:
+            if attempt == n_retries:
+                raise
+            metrics.inc("retries_total", method=func.__name__)
+            time.sleep(backoff * 2 ** attempt)
+
+
+def map_in_threads(func, items, n_threads=1):
+    # Like `map`, with up to `n_threads` calls in flight. Calls not started yet
+    # are cancelled when the generator is closed.
+    if n_threads <= 1:
+        yield from map(func, items)
+        return
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    try:
+        yield from executor.map(func, items)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def convert_data_files(dataset_path, from_format, to_format):
+    # Rewrites every saved DataFrame under `dataset_path` in `to_format`.
+    # Intermediate `i{N}_` checkpoints and split files are left as they are.
+    from_suffix = STORAGE_SUFFIXES[from_format]
+    for f in sorted(Path(dataset_path).rglob(f"*{from_suffix}")):
+        if f.parent.name == PurePath(config.SPLIT_LABELED_PATH).name:
+            continue
+        if re.match(r"i\d+_", f.name):
+            continue
+        df = read_df(f.parent, f.stem, from_format)
+        write_df(df, f.parent, f.stem, to_format)
+        print(f"converted {f} to {to_format}")
+
+
+@metrics.timed_stage("split_files_by_lines")
+def split_files_by_lines(reading_path, writing_path, writing_filename, n_lines):
+    # Reads one file at a time, writing out each split file as soon as it has
+    # `n_lines`, so only about one file and one split are held in memory.
+    path = Path(reading_path)
+    print(f"reading from {reading_path}")
+
+    suffix = STORAGE_SUFFIXES[config.STORAGE_FORMAT]
+    all_names = sorted(
+        f.stem for f in path.iterdir() if f.is_file() and f.suffix.lower() == suffix
+    )
 
     Path(writing_path).mkdir(parents=True, exist_ok=True)
-    for i in range(len(chunks) - 1):
-        df.iloc[chunks[i] : chunks[i + 1]].to_json(
+
+    def write_split(split_dfs, i):
+        pd.concat(split_dfs, ignore_index=True).to_json(
             str(PurePath(writing_path, f"{writing_filename}_{i}.json")),
             orient="records",
         )
+
+    seen_video_ids = set()
+    split_dfs = []
+    split_len = 0
+    i = 0
+    for f_name in all_names:
+        df = read_df(path, f_name)
+
+        video_ids = df["video_ids"] if "video_ids" in df else df.index.to_series()
+        is_new = ~(video_ids.duplicated() | video_ids.isin(seen_video_ids))
+        seen_video_ids.update(video_ids[is_new])
+        df = df[is_new.values]
+        metrics.inc("rows_total", len(df), stage="split_files_by_lines")
+
+        start = 0
+        while start < len(df):
+            end = start + min(n_lines - split_len, len(df) - start)
+            split_dfs.append(df.iloc[start:end])
+            split_len += end - start
+            start = end
+
+            if split_len == n_lines:
+                write_split(split_dfs, i)
+                split_dfs = []
+                split_len = 0
+                i += 1
+
+    if split_len > 0:
+        write_split(split_dfs, i)
     print(f"saved files to {writing_path}")
 
 
@@ -82,3 +457,4 @@ if __name__ == "__main__":
     split_files_by_lines(
         read_path, write_path, config.SPLIT_LABELED_FILENAME, config.SPLIT_FILE_N_LINES
     )
+    metrics.save()
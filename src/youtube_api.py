@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+import requests
+
+from collections import Counter
+from requests.adapters import HTTPAdapter
+
+import metrics
+import utils
+
+API_URL = "https://www.googleapis.com/youtube/v3"
+
+# Units taken from the daily quota per call of `<resource>.list`, see
+# https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_UNITS = {"search": 100, "channels": 1, "playlists": 1, "playlistItems": 1}
+QUOTA_REASONS = {"quotaExceeded", "dailyLimitExceeded"}
+# Requests sent too fast, which go through again after a backoff
+TRANSIENT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+class YouTubeApiError(Exception):
+    def __init__(self, message, status=None, reason=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+class QuotaExceededError(YouTubeApiError):
+    pass
+
+
+class TooManyResultsError(YouTubeApiError):
+    pass
+
+
+class TransientApiError(YouTubeApiError):
+    pass  # server errors and rate limits, worth retrying
+
+
+class YouTubeClient:
+    """`list` requests of the YouTube Data API over pooled HTTP connections,
+    safe to share between threads. Pages are saved in `cache` (a DiskCache)
+    and reused for up to `max_age` seconds, and the quota units spent are
+    counted per resource, raising QuotaExceededError past `quota_limit`.
+    Point `api_url` at a local stand-in server to test without the API."""
+
+    def __init__(
+        self,
+        api_key,
+        api_url=API_URL,
+        cache=None,
+        max_age=None,
+        quota_limit=None,
+        n_connections=10,
+        n_retries=0,
+        backoff=1.0,
+        timeout=30,
+    ):
+        self.api_key = api_key
+        self.api_url = api_url.rstrip("/")
+        self.cache = cache
+        self.max_age = max_age
+        self.quota_limit = quota_limit
+        self.n_retries = n_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.quota_used = Counter()
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=n_connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def list(self, resource, **params):
+        # One page of `<resource>.list`, e.g. list("playlists", channelId=...)
+        params = {name: value for name, value in params.items() if value is not None}
+        cache_key = None
+        if self.cache is not None:
+            # the API key is left out, so it isn't saved with the pages
+            cache_key = utils.DiskCache.key(
+                self.api_url, resource, json.dumps(params, sort_keys=True)
+            )
+            cached = self.cache.get(cache_key)
+            if cached is not None and (
+                self.max_age is None or time.time() - cached["time"] <= self.max_age
+            ):
+                metrics.inc("cache_hits_total", cache="api")
+                return cached["page"]
+            metrics.inc("cache_misses_total", cache="api")
+
+        self.spend_quota(resource)
+        page = utils.call_with_retries(
+            self.get_page,
+            resource,
+            params,
+            n_retries=self.n_retries,
+            backoff=self.backoff,
+            retry_on=(
+                TransientApiError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ),
+        )
+        if self.cache is not None:
+            self.cache.put(cache_key, {"time": time.time(), "page": page})
+        return page
+
+    def spend_quota(self, resource):
+        units = QUOTA_UNITS.get(resource, 1)
+        with self.lock:
+            spent = sum(self.quota_used.values())
+            if self.quota_limit is not None and spent + units > self.quota_limit:
+                raise QuotaExceededError(
+                    f"{resource}.list needs {units} quota units, {spent} of the "
+                    f"{self.quota_limit} allowed are spent"
+                )
+            self.quota_used[resource] += units
+        metrics.inc("quota_units_total", units, method=f"{resource}.list")
+
+    def get_page(self, resource, params):
+        response = self.session.get(
+            f"{self.api_url}/{resource}",
+            params={**params, "key": self.api_key},
+            timeout=self.timeout,
+        )
+        if response.ok:
+            return response.json()
+
+        try:
+            error = response.json()["error"]
+            message = error["message"]
+            reason = error["errors"][0]["reason"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            message = response.text[:200]
+            reason = None
+        message = f"{resource}.list failed with {response.status_code}: {message}"
+
+        if reason in QUOTA_REASONS:
+            raise QuotaExceededError(message, response.status_code, reason)
+        if reason in TRANSIENT_REASONS or response.status_code >= 500:
+            raise TransientApiError(message, response.status_code, reason)
+        raise YouTubeApiError(message, response.status_code, reason)